@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#  Benchmarks of the triangulation pipeline of tmtriangulate.py on synthetic phrase tables
+#  It generates a source-pivot and a pivot-target table of a given number of lines, with
+#  Zipfian pivot fanout and a given alignment density, and times the stages of the pipeline:
+#  triangulate (Triangulate_TMs.triangulate_standard), sort (sort_file) and merge (Merge_TM._combine_TM)
+#  Each stage runs in its own process, which reports its peak RSS
+#  The results (seconds, lines/s, peak RSS) are written as JSON and can be compared with a previous run
+#
+#  ./benchmark.py --lines 20000 100000 -o results.json
+#  ./benchmark.py --lines 20000 100000 -o new.json --compare results.json
+
+from __future__ import division, unicode_literals
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import subprocess
+import argparse
+from bisect import bisect
+from datetime import datetime
+from multiprocessing import Process, Queue, cpu_count
+from tempfile import mkdtemp
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+try:
+    from Queue import Empty
+except:
+    from queue import Empty
+
+try:
+    import resource
+except:
+    resource = None
+
+import tmtriangulate
+
+STAGES = ['triangulate', 'sort', 'merge']
+
+# --------------------------------------------------------------------------
+# Section 1: The command parser
+# --------------------------------------------------------------------------
+def parse_command_line():
+
+    parser = argparse.ArgumentParser(description="Benchmark the triangulation pipeline on synthetic phrase tables")
+
+    group1 = parser.add_argument_group('Synthetic phrase tables')
+    group2 = parser.add_argument_group('Pipeline options')
+    group3 = parser.add_argument_group('Results')
+
+    group1.add_argument('--lines', type=int, nargs='+',
+                    default=[20000], metavar='N',
+                    help='Number of lines of each phrase table, one benchmark per number. (default: %(default)s)')
+
+    group1.add_argument('--zipf', type=float,
+                    default=1.5, metavar='S',
+                    help='Exponent of the Zipfian distribution of the number of lines of a pivot phrase. (default: %(default)s)')
+
+    group1.add_argument('--max-fanout', dest='max_fanout', type=int,
+                    default=100, metavar='K',
+                    help='Largest number of lines of a pivot phrase in each table. (default: %(default)s)')
+
+    group1.add_argument('--alignment-density', dest='density', type=float,
+                    default=0.3, metavar='D',
+                    help='Probability that a pair of words of a phrase pair is aligned. (default: %(default)s)')
+
+    group1.add_argument('--vocabulary', type=int,
+                    default=10000, metavar='V',
+                    help='Number of words of each language. (default: %(default)s)')
+
+    group1.add_argument('--seed', type=int,
+                    default=1,
+                    help='Seed of the generator. (default: %(default)s)')
+
+    group2.add_argument('action', metavar='ACTION', nargs='?',
+                    default='features_based',
+                    choices=["features_based", "counts_based"],
+                    help='Which triangulation method to apply. One of: %(choices)s. (default: %(default)s)')
+
+    group2.add_argument('-m', '--mode', type=str,
+                    default='pspt',
+                    choices=["sppt", "pspt", "pstp", "sptp"],
+                    help='Input mode of the generated tables, the tables of the other modes are inverted. (default: %(default)s)')
+
+    group2.add_argument('-j', '--jobs', dest='jobs', type=int,
+                    default=1, metavar='N',
+                    help='Number of processes triangulating shards. (default: %(default)s)')
+
+    group2.add_argument('--join', dest='join', type=str,
+                    default='auto',
+                    choices=['auto', 'merge', 'hash'],
+                    help='Join of the phrase tables. (default: %(default)s)')
+
+    group2.add_argument('-S', '--sort-buffer-size', dest='sort_buffer_size', type=tmtriangulate._parse_size,
+                    default='256M', metavar='SIZE',
+                    help='Memory used by the external sort. (default: %(default)s)')
+
+    group2.add_argument('-tmpdir', '--tmpdir', dest='tmp', type=str,
+                    default=".",
+                    help='Directory of the generated tables and the intermediate files. (default: the current directory)')
+
+    group3.add_argument('-r', '--repeat', type=int,
+                    default=1, metavar='R',
+                    help='Run each benchmark R times and keep the fastest time of each stage. (default: %(default)s)')
+
+    group3.add_argument('-o', '--output', type=str,
+                    default=None,
+                    help='Write the results as JSON to this file')
+
+    group3.add_argument('--compare', type=str,
+                    default=None, metavar='FILE',
+                    help='Compare the results with a previous JSON file, exit with 1 if a stage is slower')
+
+    group3.add_argument('--tolerance', type=float,
+                    default=0.2, metavar='T',
+                    help='A stage is reported as slower when it takes more than 1+T times as long. (default: %(default)s)')
+
+    return parser.parse_args()
+
+# --------------------------------------------------------------------------
+# Section 2: Synthetic phrase tables
+# --------------------------------------------------------------------------
+class TableGenerator():
+    """ Generate the two phrase tables of a triangulation, which share their pivot phrases
+        The number of lines of a pivot phrase in each table follows a Zipfian distribution
+    """
+    def __init__(self, zipf=1.5, max_fanout=100, density=0.3, vocabulary=10000, seed=1, max_phrase_length=3):
+        self.random = random.Random(seed)
+        self.density = density
+        self.vocabulary = vocabulary
+        self.max_phrase_length = max_phrase_length
+        self.pivots = []
+        self.pivot_set = set()
+
+        # the cumulative weights of the fanouts 1..max_fanout
+        self.fanouts = []
+        total = 0.0
+        for k in range(1, max_fanout+1):
+            total += k ** -zipf
+            self.fanouts.append(total)
+
+    def _fanout(self):
+        return bisect(self.fanouts, self.random.random() * self.fanouts[-1]) + 1
+
+    def _phrase(self, prefix):
+        length = self.random.randint(1, self.max_phrase_length)
+        return b' '.join([b'%s%d' %(prefix, self.random.randrange(self.vocabulary)) for i in range(length)])
+
+    def _pivot(self, i):
+        ''' The i-th pivot phrase, the same in both tables
+        '''
+        while (len(self.pivots) <= i):
+            phrase = self._phrase(b'p')
+            if phrase not in self.pivot_set:
+                self.pivot_set.add(phrase)
+                self.pivots.append(phrase)
+        return self.pivots[i]
+
+    def _alignment(self, length1, length2):
+        points = [(i, j) for i in range(length1) for j in range(length2) if self.random.random() < self.density]
+        if (not points):
+            points = [(self.random.randrange(length1), self.random.randrange(length2))]
+        return b' '.join([b'%d-%d' %(i, j) for i, j in points])
+
+    def _line(self, pivot, phrase, pivot_first):
+        ''' A phrase table line: src ||| tgt ||| 4 features ||| alignment ||| counts ||| |||
+        '''
+        features = b' '.join([b'%.6g' %(self.random.uniform(0.0001, 1.0)) for i in range(4)])
+        joint = self.random.randint(1, 5)
+        counts = b'%d %d %d' %(joint + self.random.randint(0, 50), joint + self.random.randint(0, 50), joint)
+        if (pivot_first):
+            src, tgt = pivot, phrase
+        else:
+            src, tgt = phrase, pivot
+        alignment = self._alignment(len(src.split(b' ')), len(tgt.split(b' ')))
+        return b'%s ||| %s ||| %s ||| %s ||| %s ||| |||\n' %(src, tgt, features, alignment, counts)
+
+    def write(self, filename, lines, prefix, pivot_first=True):
+        ''' Write a table of `lines` lines whose other phrases start with prefix
+            A table whose first phrase is the pivot phrase is sorted like LC_ALL=C sort,
+            the other tables are left in random order
+        '''
+        table = []
+        i = 0
+        while (len(table) < lines):
+            pivot = self._pivot(i)
+            i += 1
+            phrases = set()
+            for k in range(min(self._fanout(), lines - len(table))):
+                phrase = self._phrase(prefix)
+                if phrase in phrases:
+                    continue
+                phrases.add(phrase)
+                table.append(self._line(pivot, phrase, pivot_first))
+        if (pivot_first):
+            table.sort()
+        else:
+            self.random.shuffle(table)
+        with open(filename, 'wb') as outfile:
+            outfile.writelines(table)
+        return i
+
+# --------------------------------------------------------------------------
+# Section 3: Running the stages
+# --------------------------------------------------------------------------
+def _peak_rss():
+    ''' The peak memory in MB of this process and of its finished child processes (e.g. the shards)
+    '''
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) // 1024
+
+def _count_lines(filename):
+    with open(filename, 'rb') as infile:
+        return sum(1 for line in infile)
+
+def _stage_triangulate(args, directory, table1, table2):
+    ''' Triangulate the tables into directory/phrase-table, and keep the word and phrase counts for the merge
+    '''
+    triangulator = tmtriangulate.Triangulate_TMs(model1=table1,
+                               model2=table2,
+                               mode=args.mode,
+                               action=args.action,
+                               weight='summation',
+                               computed='min',
+                               output_file=os.path.join(directory, 'phrase-table'),
+                               output_lexical='lex',
+                               tempdir=directory,
+                               jobs=args.jobs,
+                               join=args.join)
+    start = time.time()
+    triangulator.triangulate_standard()
+    seconds = time.time() - start
+    with open(os.path.join(directory, 'counts'), 'wb') as outfile:
+        pickle.dump((triangulator.mode, triangulator.moses_interface._export_counts()), outfile, 2)
+    return seconds, triangulator.stats['pairs']
+
+def _stage_sort(args, directory, pairs):
+    ''' Sort directory/phrase-table into directory/phrase-table.sorted
+    '''
+    filename = os.path.join(directory, 'phrase-table')
+    start = time.time()
+    sorted_file = tmtriangulate.sort_file(filename, tempdir=directory, records=True)
+    seconds = time.time() - start
+    sorted_file.close()
+    os.rename(sorted_file.name, filename + '.sorted')
+    os.remove(filename)
+    return seconds, pairs
+
+def _stage_merge(args, directory, pairs):
+    ''' Combine the identical phrase pairs of directory/phrase-table.sorted
+    '''
+    with open(os.path.join(directory, 'counts'), 'rb') as infile:
+        mode, counts = pickle.load(infile)
+    moses = tmtriangulate.Moses(4, directory)
+    moses._add_counts(*counts)
+    sorted_file = tmtriangulate._RecordFile(open(os.path.join(directory, 'phrase-table.sorted'), 'rb'))
+    output_file = os.path.join(directory, 'phrase-table.triangulated')
+    start = time.time()
+    merger = tmtriangulate.Merge_TM(model=sorted_file,
+                      output_file=output_file,
+                      mode=mode,
+                      action=args.action,
+                      output_lexical='lex',
+                      moses_interface=moses,
+                      weight='summation',
+                      tempdir=directory)
+    merger._combine_TM()
+    seconds = time.time() - start
+    sorted_file.close()
+    return seconds, _count_lines(output_file)
+
+def _glob_run_stage(function, arguments, queue):
+    ''' Run a stage and put its time, its number of output lines and the peak memory of the process
+    '''
+    seconds, output_lines = function(*arguments)
+    queue.put((seconds, output_lines, _peak_rss()))
+
+def run_stage(name, function, arguments):
+    ''' Run a stage in a new process, so that the peak memory is the one of the stage
+        Raise RuntimeError when the process fails
+    '''
+    queue = Queue()
+    p = Process(target=_glob_run_stage, args=[function, arguments, queue])
+    p.start()
+    result = None
+    # a failed stage exits without a result
+    while (result is None and p.is_alive()):
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            pass
+    if (result is None):
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            pass
+    p.join()
+    if (p.exitcode or result is None):
+        raise RuntimeError("The {0} stage failed with exit code {1}".format(name, p.exitcode))
+    return result
+
+def run_pipeline(args, directory, table1, table2, lines):
+    ''' Run the stages of the pipeline like tmtriangulate.py does, one process each,
+        and return their timings
+    '''
+    results = []
+    def add_result(name, input_lines, seconds, output_lines, peak_rss):
+        results.append({'lines': lines,
+                        'stage': name,
+                        'seconds': seconds,
+                        'input_lines': input_lines,
+                        'output_lines': output_lines,
+                        'lines_per_second': input_lines / seconds if seconds else None,
+                        'peak_rss_mb': peak_rss})
+        sys.stderr.write("{0}: {1} lines, {2:.2f}s\n".format(name, input_lines, seconds))
+
+    seconds, pairs, peak_rss = run_stage('triangulate', _stage_triangulate, [args, directory, table1, table2])
+    add_result('triangulate', 2*lines, seconds, pairs, peak_rss)
+    for name, function in [('sort', _stage_sort), ('merge', _stage_merge)]:
+        seconds, output_lines, peak_rss = run_stage(name, function, [args, directory, pairs])
+        add_result(name, pairs, seconds, output_lines, peak_rss)
+    return results
+
+def benchmark(args, lines):
+    ''' Generate the tables of `lines` lines and run the pipeline args.repeat times
+        Return the fastest time of each stage, with the largest peak memory
+    '''
+    directory = mkdtemp(dir=args.tmp, prefix='benchmark')
+    try:
+        generator = TableGenerator(zipf=args.zipf, max_fanout=args.max_fanout, density=args.density,
+                                   vocabulary=args.vocabulary, seed=args.seed)
+        table1 = os.path.join(directory, 'model1')
+        table2 = os.path.join(directory, 'model2')
+        sys.stderr.write("Generate two tables of {0} lines in {1}\n".format(lines, directory))
+        generator.write(table1, lines, b's', pivot_first=args.mode.startswith('ps'))
+        generator.write(table2, lines, b't', pivot_first=args.mode.endswith('pt'))
+        generator = None
+
+        best = {}
+        for i in range(args.repeat):
+            rundir = os.path.join(directory, 'run')
+            os.mkdir(rundir)
+            results = run_pipeline(args, rundir, table1, table2, lines)
+            shutil.rmtree(rundir)
+            for result in results:
+                kept = best.get(result['stage'])
+                if kept is None or result['seconds'] < kept['seconds']:
+                    if kept is not None:
+                        result['peak_rss_mb'] = max(result['peak_rss_mb'], kept['peak_rss_mb'])
+                    best[result['stage']] = result
+                elif result['peak_rss_mb'] > kept['peak_rss_mb']:
+                    kept['peak_rss_mb'] = result['peak_rss_mb']
+    finally:
+        shutil.rmtree(directory)
+    return [best[name] for name in STAGES if name in best]
+
+# --------------------------------------------------------------------------
+# Section 4: Results
+# --------------------------------------------------------------------------
+def _revision():
+    ''' The git revision of tmtriangulate.py, None outside of a git repository
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                    cwd=os.path.dirname(os.path.abspath(tmtriangulate.__file__)), stderr=open(os.devnull, 'w')).strip()
+    except:
+        return None
+
+def write_results(results, filename):
+    with open(filename, 'w') as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+        outfile.write('\n')
+
+def print_results(results):
+    sys.stdout.write("{0:>10} {1:<12} {2:>10} {3:>12} {4:>8}\n".format('lines', 'stage', 'seconds', 'lines/s', 'peak MB'))
+    for result in results['results']:
+        sys.stdout.write("{0:>10} {1:<12} {2:>10.2f} {3:>12.0f} {4:>8}\n".format(
+            result['lines'], result['stage'], result['seconds'], result['lines_per_second'] or 0, result['peak_rss_mb']))
+
+def compare_results(results, baseline, tolerance):
+    ''' Print the ratio of the times of each stage to a previous run
+        Return the stages which took more than 1+tolerance times as long
+    '''
+    previous = dict(((result['lines'], result['stage']), result) for result in baseline['results'])
+    if (baseline.get('settings') != results['settings']):
+        sys.stdout.write("Warning: the settings differ from the compared results\n")
+    slower = []
+    sys.stdout.write("\nCompared with {0} ({1}):\n".format(baseline.get('revision'), baseline.get('date')))
+    for result in results['results']:
+        old = previous.get((result['lines'], result['stage']))
+        if old is None or not old['seconds']:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        mark = ''
+        if (ratio > 1 + tolerance):
+            mark = 'SLOWER'
+            slower.append(result)
+        sys.stdout.write("{0:>10} {1:<12} {2:>10.2f} {3:>10.2f} {4:>8.2f}x {5}\n".format(
+            result['lines'], result['stage'], old['seconds'], result['seconds'], ratio, mark))
+    return slower
+
+# --------------------------------------------------------------------------
+# Section 0: Main function
+# --------------------------------------------------------------------------
+if __name__ == "__main__":
+    args = parse_command_line()
+    # the stage processes inherit the settings of the module
+    tmtriangulate.sort_buffer_size = args.sort_buffer_size
+    tmtriangulate.io_threads = args.jobs
+    results = {'date': datetime.now().isoformat(),
+               'revision': _revision(),
+               'python': platform.python_version(),
+               'cpus': cpu_count(),
+               'settings': {'action': args.action,
+                            'mode': args.mode,
+                            'jobs': args.jobs,
+                            'join': args.join,
+                            'sort_buffer_size': args.sort_buffer_size,
+                            'zipf': args.zipf,
+                            'max_fanout': args.max_fanout,
+                            'alignment_density': args.density,
+                            'vocabulary': args.vocabulary,
+                            'seed': args.seed,
+                            'repeat': args.repeat},
+               'results': []}
+    for lines in args.lines:
+        try:
+            results['results'].extend(benchmark(args, lines))
+        except RuntimeError as e:
+            sys.stderr.write("Benchmark of {0} lines: {1}\n".format(lines, e))
+            exit(1)
+
+    print_results(results)
+    if (args.output):
+        write_results(results, args.output)
+    if (args.compare):
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+        if (compare_results(results, baseline, args.tolerance)):
+            exit(1)
@@ -10,13 +10,15 @@
 # Before Dec 2014: The author was too lazy to use GitHub, no revision control.
 
 from __future__ import division, unicode_literals
-import sys, os, gzip, re
+import sys, os, gzip, re, shutil, struct, mmap, zlib, threading, hashlib
 import argparse
 import copy
-from collections import defaultdict
+import heapq
+from array import array
+from collections import defaultdict, deque
 from tempfile import NamedTemporaryFile
-from subprocess import Popen
 from multiprocessing import Pool,Value,Process
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 
 try:
@@ -24,6 +26,63 @@ try:
 except:
     izip = zip
 
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+try:
+    from Queue import Queue, Empty
+except:
+    from queue import Queue, Empty
+
+try:
+    import lz4.frame as lz4frame
+except:
+    lz4frame = None
+
+try:
+    import zstandard
+except:
+    zstandard = None
+
+try:
+    import numpy
+except:
+    numpy = None
+
+try:
+    import resource
+except:
+    resource = None
+
+# Settings of the external sort, see --sort-buffer-size and --sort-compress
+sort_buffer_size = 256*1024*1024
+sort_compress = None
+sort_max_runs = 128
+
+# Pivot groups with fewer pairs are not worth the NumPy arrays
+batch_min_pairs = 64
+# Number of records written at once
+write_batch_size = 10000
+# Number of composed word alignments kept in memory, see _compose_alignments
+alignment_memo_size = 100000
+# Number of word translation probabilities kept in memory per direction, see Moses._compute_lexical_weight
+lexical_memo_size = 100000
+
+# An indexed table is looked up by pivot phrase, instead of scanned, when the other table
+# is this many times smaller, see Triangulate_TMs._seek_side
+seek_ratio = 16
+# With --join auto, the hash join is used when the smaller table is this many times smaller
+# and fits into the sort buffer this many times (its lines and groups in memory), see Triangulate_TMs._choose_join
+hash_ratio = 16
+hash_overhead = 4
+
+# Settings of the compressed files, see --io-threads
+io_threads = 1
+io_block_size = 1024*1024
+io_queue_size = 16
+
 # --------------------------------------------------------------------------
 # Section 1: The command parser
 # --------------------------------------------------------------------------
@@ -37,11 +96,11 @@ def parse_command_line():
     group1.add_argument('action', metavar='ACTION', choices=["features_based","counts_based"],
             help='Which triangulation method to apply. One of: %(choices)s.')
 
-    group1.add_argument('-s', metavar='DIRECTORY', dest='srcpvt',
-                    help='The source and pivot phrase table')
+    group1.add_argument('-s', metavar='DIRECTORY', dest='srcpvt', nargs='+',
+                    help='The source and pivot phrase table, or one per pivot language')
 
-    group1.add_argument('-t', metavar='DIRECTORY', dest='pvttgt',
-                    help='The pivot and target phrase table')
+    group1.add_argument('-t', metavar='DIRECTORY', dest='pvttgt', nargs='+',
+                    help='The pivot and target phrase table, or one per pivot language in the order of -s')
 
     group1.add_argument('-w', '--weight', dest='weight', type=str,
                     default='summation',
@@ -75,60 +134,505 @@ def parse_command_line():
                     default=4, metavar='N',
                     help=('The number of features in the phrase table. (default: %(default)s)'))
 
-    return parser.parse_args()
+    group2.add_argument('-j', '--jobs', dest='jobs', type=int,
+                    default=1, metavar='N',
+                    help=('Number of processes triangulating shards of the pivot-sorted phrase tables. (default: %(default)s)'))
+
+    group2.add_argument('-S', '--sort-buffer-size', dest='sort_buffer_size', type=_parse_size,
+                    default='256M', metavar='SIZE',
+                    help=('Memory used by the external sort before it writes sorted runs to the temporary directory, e.g. 512M or 4G. (default: %(default)s)'))
+
+    group2.add_argument('--sort-compress', dest='sort_compress', type=str,
+                    default=None,
+                    choices=['gzip', 'lz4'],
+                    help=('Compress the sorted runs of the external sort. One of: %(choices)s'))
+
+    group2.add_argument('--max-pivot-fanout', dest='max_pivot_fanout', type=int,
+                    default=None, metavar='K',
+                    help=('Before pairing, keep the K best phrases of each pivot phrase on each side: by p(pvt|src) and by p(tgt|pvt)'))
+
+    group2.add_argument('--max-targets-per-source', dest='max_targets', type=int,
+                    default=None, metavar='N',
+                    help=('Keep the N best target phrases of each source phrase by p(tgt|src) in the final phrase table'))
+
+    group2.add_argument('--min-prob', dest='min_prob', type=float,
+                    default=None, metavar='P',
+                    help=('Drop triangulated phrase pairs whose p(s|t) and p(t|s) are both below P'))
+
+    group2.add_argument('--min-count', dest='min_count', type=float,
+                    default=None, metavar='C',
+                    help=('Drop triangulated phrase pairs whose estimated co-occurrence count is below C'))
+
+    group2.add_argument('--incremental', dest='incremental', type=str,
+                    default=None, metavar='DIRECTORY',
+                    help=('Keep the triangulation in DIRECTORY and, in the next run, re-triangulate only the pivot phrases whose rows changed in either phrase table'))
+
+    group2.add_argument('--cache', dest='cache', type=str,
+                    default=None, metavar='DIRECTORY',
+                    help=('Keep the prepared phrase tables (inverted and pivot-sorted, binary-encoded or decompressed) in DIRECTORY by the checksum of the input, and reuse them in later runs'))
+
+    group2.add_argument('--cache-records', dest='cache_records', action="store_true",
+                    help=('With --cache, keep the prepared phrase tables as binary records, which are parsed only once'))
+
+    group2.add_argument('--memory-limit', dest='memory_limit', type=_parse_size,
+                    default=None, metavar='SIZE',
+                    help=('Memory of the source and target phrase counts, beyond which they are spilled to hash partitions in the temporary directory, e.g. 2G. (default: no limit)'))
+
+    group2.add_argument('--io-threads', dest='io_threads', type=int,
+                    default=None, metavar='N',
+                    help=('Number of threads compressing a gzip output phrase table. (default: the number of jobs)'))
+
+    group2.add_argument('--join', dest='join', type=str,
+                    default='auto',
+                    choices=['auto', 'merge', 'hash'],
+                    help=('Join of the phrase tables: merge the pivot-sorted tables, or keep the smaller table in memory and stream the larger one unsorted (hash). auto uses the hash join when the larger table would be inverted and sorted and the smaller one fits into the sort buffer. (default: %(default)s)'))
+
+    group2.add_argument('--fused', action="store_true",
+                    help=('Combine identical phrase pairs in memory during triangulation (up to the sort buffer size per process) and write sorted runs instead of the full triangulated phrase table'))
+
+    args = parser.parse_args()
+    if (not args.srcpvt or not args.pvttgt or len(args.srcpvt) != len(args.pvttgt)):
+        parser.error('-s and -t need the same number of phrase tables, one pair per pivot language')
+    if (args.incremental and len(args.srcpvt) > 1):
+        parser.error('--incremental keeps the triangulation of one pivot language')
+    return args
+
+def parse_binarize_command_line():
+
+    parser = argparse.ArgumentParser(prog='tmtriangulate.py binarize',
+                    description="Convert a phrase table into an indexed table of binary records, sorted by pivot phrase")
+
+    parser.add_argument('input', metavar='INPUT',
+                    help='The phrase table (text, gzip, zstd or lz4) or its directory (dir/model/phrase-table)')
+
+    parser.add_argument('output', metavar='OUTPUT',
+                    help='The indexed table')
+
+    parser.add_argument('--invert', action="store_true",
+                    help=('The pivot phrase is the second phrase of the table, e.g. the source-pivot table of the sppt mode'))
+
+    parser.add_argument('-tmpdir', '--tmpdir', dest='tmp', type=str,
+                    default=".",
+                    help=('Temporary directory of the external sort. By default the current directory'))
+
+    parser.add_argument('-S', '--sort-buffer-size', dest='sort_buffer_size', type=_parse_size,
+                    default='256M', metavar='SIZE',
+                    help=('Memory used by the external sort. (default: %(default)s)'))
+
+    return parser.parse_args(sys.argv[2:])
 
 # --------------------------------------------------------------------------
 # Section 2: A moses class to keep track of word counts and alignments
 # --------------------------------------------------------------------------
+NULL_ID = 0
+
+class Vocabulary():
+    ''' Map the words of one side to dense integer ids and keep the count of each word
+        The id 0 is the NULL word
+    '''
+    def __init__(self):
+        self.ids = {b'NULL': NULL_ID}
+        self.words = [b'NULL']
+        self.counts = array(b'd', [0])
+
+    def __len__(self):
+        return len(self.words)
+
+    def get_id(self, word):
+        wid = self.ids.get(word)
+        if (wid is None):
+            wid = len(self.words)
+            self.ids[word] = wid
+            self.words.append(word)
+            self.counts.append(0)
+        return wid
+
+    def get_ids(self, phrase):
+        return [self.get_id(word) for word in phrase.split(b' ')]
+
+class PairCounts():
+    ''' Counts of word pairs (e,f), the pair of ids is packed into one integer key
+        which points to a slot of the count array
+    '''
+    def __init__(self):
+        self.slots = {}
+        self.keys = array(b'L')
+        self.counts = array(b'd')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        ''' yield (e, f, count) in insertion order '''
+        counts = self.counts
+        for slot,key in enumerate(self.keys):
+            yield key >> 32, key & 0xffffffff, counts[slot]
+
+    def add(self, e, f, count):
+        key = e << 32 | f
+        slot = self.slots.get(key)
+        if (slot is None):
+            self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.counts.append(count)
+        else:
+            self.counts[slot] += count
+
+    def get(self, e, f):
+        slot = self.slots.get(e << 32 | f)
+        if (slot is None):
+            return 0
+        return self.counts[slot]
+
+    def compact(self):
+        ''' drop the pairs whose count is zero '''
+        keys, counts = array(b'L'), array(b'd')
+        for key,count in izip(self.keys,self.counts):
+            if count:
+                keys.append(key)
+                counts.append(count)
+        self.keys, self.counts = keys, counts
+        self.slots = dict((key,slot) for slot,key in enumerate(keys))
+
+class PhraseCounts():
+    ''' Counts of phrases, a missing phrase counts 0
+        Beyond memory_limit bytes, the counts are spilled into partition files by the hash of the phrase
+        After finalize(), the phrases of spilled counts are looked up in one hash table per partition,
+        which is read through a memory map
+    '''
+    PARTITIONS = 64
+    ENTRY = struct.Struct(b'<Iq') # length of the phrase, count
+    SLOT = struct.Struct(b'<IQq') # hash, offset of the phrase (0 if empty), count
+    HEADER = struct.Struct(b'<Q') # number of slots
+    # rough size of a phrase and its count in a dict
+    OVERHEAD = 100
+    # number of looked up counts kept in memory
+    CACHE = 100000
+
+    def __init__(self, tempdir=None, memory_limit=None):
+        self.tempdir = tempdir
+        self.memory_limit = memory_limit
+        self.counts = {}
+        self.size = 0
+        self.files = None
+        self.tables = None
+        self.cache = {}
+
+    def add(self, phrase, count):
+        if phrase in self.counts:
+            self.counts[phrase] += count
+            return
+        self.counts[phrase] = count
+        self.size += len(phrase) + self.OVERHEAD
+        if (self.memory_limit and self.size >= self.memory_limit):
+            self._spill()
+
+    def update(self, counts):
+        ''' add the counts of another PhraseCounts, see export
+        '''
+        items, files = counts
+        for phrase,count in items.iteritems():
+            self.add(phrase, count)
+        for filename in files:
+            for phrase,count in self._read_partition(filename):
+                self.add(phrase, count)
+            os.remove(filename)
+
+    def iteritems(self):
+        ''' yield the phrases and their counts, before finalize()
+        '''
+        if (self.files is None):
+            for item in self.counts.iteritems():
+                yield item
+            return
+        buckets = [{} for i in range(self.PARTITIONS)]
+        for phrase,count in self.counts.iteritems():
+            buckets[self._bucket(phrase)][phrase] = count
+        for filename,counts in zip(self.files,buckets):
+            counts = defaultdict(long, counts)
+            for phrase,count in self._read_partition(filename):
+                counts[phrase] += count
+            for item in counts.iteritems():
+                yield item
+
+    def export(self):
+        ''' the counts in memory and the names of the partition files, which are handed over
+        '''
+        files, self.files = self.files or [], None
+        return (self.counts, files)
+
+    def _bucket(self, phrase):
+        return (zlib.crc32(phrase) & 0xffffffff) % self.PARTITIONS
+
+    def _spill(self):
+        if (self.files is None):
+            self.files = []
+            for i in range(self.PARTITIONS):
+                outfile = NamedTemporaryFile(delete=False,dir=self.tempdir,prefix='counts')
+                outfile.close()
+                self.files.append(outfile.name)
+        buckets = [[] for i in range(self.PARTITIONS)]
+        for phrase,count in self.counts.iteritems():
+            buckets[self._bucket(phrase)].append(self.ENTRY.pack(len(phrase),count) + phrase)
+        for filename,bucket in zip(self.files,buckets):
+            with open(filename,'ab') as outfile:
+                outfile.write(b''.join(bucket))
+        self.counts, self.size = {}, 0
+
+    def _read_partition(self, filename):
+        ''' yield the phrases and counts of a partition file '''
+        with open(filename,'rb') as infile:
+            data = infile.read()
+        pos = 0
+        while (pos < len(data)):
+            length, count = self.ENTRY.unpack_from(data,pos)
+            pos += self.ENTRY.size
+            yield data[pos:pos+length], count
+            pos += length
+
+    def finalize(self):
+        ''' Sum up the spilled counts of each partition into its hash table
+        '''
+        if (self.files is None):
+            return
+        self._spill()
+        sys.stderr.write("Build the hash tables of {0} partitions of phrase counts\n".format(self.PARTITIONS))
+        self.tables = []
+        for filename in self.files:
+            counts = defaultdict(long)
+            for phrase,count in self._read_partition(filename):
+                counts[phrase] += count
+            self._write_table(filename, counts)
+            counts = None
+            with open(filename,'rb') as infile:
+                self.tables.append(mmap.mmap(infile.fileno(),0,access=mmap.ACCESS_READ))
+
+    def _write_table(self, filename, counts):
+        ''' Write an open addressing hash table with linear probing, followed by the phrases
+        '''
+        nslots = 2*len(counts) + 1
+        slots = [(0,0,0)]*nslots
+        heap, offset = [], self.HEADER.size + nslots*self.SLOT.size
+        for phrase,count in counts.iteritems():
+            code = zlib.crc32(phrase) & 0xffffffff
+            slot = (code // self.PARTITIONS) % nslots
+            while (slots[slot][1]):
+                slot = (slot+1) % nslots
+            slots[slot] = (code, offset, count)
+            heap.append(self.ENTRY.pack(len(phrase),count) + phrase)
+            offset += self.ENTRY.size + len(phrase)
+        with open(filename,'wb') as outfile:
+            outfile.write(self.HEADER.pack(nslots))
+            outfile.write(b''.join([self.SLOT.pack(*entry) for entry in slots]))
+            outfile.write(b''.join(heap))
+
+    def __getitem__(self, phrase):
+        if (self.tables is None):
+            return self.counts.get(phrase, 0)
+        count = self.cache.get(phrase)
+        if (count is None):
+            count = self._lookup(phrase)
+            if (len(self.cache) >= self.CACHE):
+                self.cache.clear()
+            self.cache[phrase] = count
+        return count
+
+    def _lookup(self, phrase):
+        code = zlib.crc32(phrase) & 0xffffffff
+        table = self.tables[code % self.PARTITIONS]
+        nslots = self.HEADER.unpack_from(table,0)[0]
+        slot = (code // self.PARTITIONS) % nslots
+        while True:
+            slot_code, offset, count = self.SLOT.unpack_from(table, self.HEADER.size + slot*self.SLOT.size)
+            if (not offset):
+                return 0
+            if (slot_code == code):
+                length = self.ENTRY.unpack_from(table,offset)[0]
+                start = offset + self.ENTRY.size
+                if (table[start:start+length] == phrase):
+                    return count
+            slot = (slot+1) % nslots
+
+    def close(self):
+        ''' remove the partition files '''
+        for table in self.tables or []:
+            table.close()
+        for filename in self.files or []:
+            os.remove(filename)
+        self.tables, self.files = None, None
+
+class SharedCounts():
+    ''' The word counts of a Moses interface copied into one anonymous shared memory block,
+        so that processes forked afterwards read them without touching the Python objects
+        Layout: the six sizes, the pair keys and counts, the word counts of e and f,
+        the words of e and f separated by line breaks
+    '''
+    HEADER = struct.Struct(b'<6Q')
+    # number of pairs read at once
+    CHUNK = 65536
+
+    def __init__(self, moses):
+        pairs = moses.word_pairs_e2f
+        words_e = b'\n'.join(moses.vocab_e.words)
+        words_f = b'\n'.join(moses.vocab_f.words)
+        parts = [pairs.keys, pairs.counts, moses.word_count_e, moses.word_count_f]
+        self.sizes = [len(part)*part.itemsize for part in parts] + [len(words_e), len(words_f)]
+        self.map = mmap.mmap(-1, self.HEADER.size + sum(self.sizes))
+        self.map.write(self.HEADER.pack(*self.sizes))
+        for part in parts:
+            # without a temporary copy of the whole array
+            for start in range(0, len(part), self.CHUNK):
+                self.map.write(part[start:start+self.CHUNK].tostring())
+        self.map.write(words_e)
+        self.map.write(words_f)
+        self.itemsize = pairs.keys.itemsize
+
+    def _offset(self, part):
+        return self.HEADER.size + sum(self.sizes[:part])
+
+    def __len__(self):
+        return self.sizes[0]//self.itemsize
+
+    def pairs(self):
+        ''' yield (e, f, count) in insertion order '''
+        keys_at, counts_at = self._offset(0), self._offset(1)
+        for start in range(0, len(self), self.CHUNK):
+            end = min(start+self.CHUNK, len(self))
+            keys, counts = array(b'L'), array(b'd')
+            keys.fromstring(self.map[keys_at+start*self.itemsize:keys_at+end*self.itemsize])
+            counts.fromstring(self.map[counts_at+start*8:counts_at+end*8])
+            for key,count in izip(keys,counts):
+                yield key >> 32, key & 0xffffffff, count
+
+    def word_counts(self, side):
+        ''' the word counts of the side e or f, indexed by id '''
+        part = 2 if side == 'e' else 3
+        counts = array(b'd')
+        counts.fromstring(self.map[self._offset(part):self._offset(part+1)])
+        return counts
+
+    def words(self, side):
+        ''' the words of the side e or f, indexed by id '''
+        part = 4 if side == 'e' else 5
+        return self.map[self._offset(part):self._offset(part+1)].split(b'\n')
+
+    def close(self):
+        self.map.close()
+
 class Moses:
     ''' Moses interface for loading/writing models
         It keeps the value of src-pvt word count
     '''
-    def __init__(self, number_of_features=4):
+    def __init__(self, number_of_features=4, tempdir=None, memory_limit=None):
         self.number_of_features = number_of_features
 
-        self.word_pairs_e2f = defaultdict(lambda: defaultdict(long))
+        # words are kept as ids of the source (e) and target (f) vocabularies
+        self.vocab_e = Vocabulary()
+        self.vocab_f = Vocabulary()
+        self.word_pairs_e2f = PairCounts()
         #self.word_pairs_f2e = defaultdict(lambda:defaultdict(long))
 
-        self.word_count_e = defaultdict(long)
-        self.word_count_f = defaultdict(long)
+        # arrays indexed by word ids
+        self.word_count_e = self.vocab_e.counts
+        self.word_count_f = self.vocab_f.counts
+
+        # the co-occurrence counts summed by target phrase (f) and by source phrase (e),
+        # which share the memory limit
+        if memory_limit:
+            memory_limit //= 2
+        self.phrase_count_f = PhraseCounts(tempdir, memory_limit)
+        self.phrase_count_e = PhraseCounts(tempdir, memory_limit)
+
+        # word translation probabilities w(e|f) and w(f|e) by pair key, see _compute_lexical_weight
+        # both are cleared when they reach lexical_memo_size
+        self.lexical_st = {}
+        self.lexical_ts = {}
+        # the ids of the last source phrase, the merged lines are sorted by source phrase
+        self.last_src = None
+        self.last_src_ids = None
+
+    def _add_pair(self,e,f,count):
+        '''
+        count the co-occurrence of the words e and f (ids)
+        '''
+        self.word_pairs_e2f.add(e,f,count)
+        self.word_count_e[e] += count
+        self.word_count_f[f] += count
 
-        self.phrase_count_f = None # name of the file with format tgt ||| src ||| count (sorted by tgt)
-        self.phrase_count_e = None # name of the file with format src ||| tgt ||| count (sorted by tgt)
+    def _export_counts(self):
+        '''
+        the word counts as picklable arrays, ids are only valid together with the word lists,
+        and the phrase counts
+        '''
+        return (self.vocab_e.words, self.vocab_f.words, self.word_pairs_e2f.keys, self.word_pairs_e2f.counts,
+                self.phrase_count_e.export(), self.phrase_count_f.export())
+
+    def _save_counts(self):
+        '''
+        the word and phrase counts like _export_counts, with the phrase counts in memory
+        '''
+        return (self.vocab_e.words, self.vocab_f.words, self.word_pairs_e2f.keys, self.word_pairs_e2f.counts,
+                (dict(self.phrase_count_e.iteritems()), []), (dict(self.phrase_count_f.iteritems()), []))
+
+    def _add_counts(self,words_e,words_f,keys,counts,phrase_count_e,phrase_count_f):
+        '''
+        add the word and phrase counts collected by another process, e.g. a triangulation shard
+        '''
+        ids_e = [self.vocab_e.get_id(e) for e in words_e]
+        ids_f = [self.vocab_f.get_id(f) for f in words_f]
+        for key,val in izip(keys,counts):
+            self._add_pair(ids_e[key >> 32],ids_f[key & 0xffffffff],val)
+        self.phrase_count_e.update(phrase_count_e)
+        self.phrase_count_f.update(phrase_count_f)
 
     def _compute_lexical_weight(self,src,tgt,alignments):
         '''
         compute the lexical weight in phrase table based on the co-occurrence of word count
+        The word translation probabilities are cached, so the word counts must be final
         '''
-        align_rev = defaultdict(lambda: [])
-        alignment=defaultdict(lambda:[])
-
-        phrase_src = src.split(b' ')
-        phrase_tgt = tgt.split(b' ')
+        if (src != self.last_src):
+            self.last_src,self.last_src_ids = src,self.vocab_e.get_ids(src)
+        phrase_src = self.last_src_ids
+        phrase_tgt = self.vocab_f.get_ids(tgt)
+        pairs = self.word_pairs_e2f
+        cache_st,cache_ts = self.lexical_st,self.lexical_ts
+        if (len(cache_st) >= lexical_memo_size or len(cache_ts) >= lexical_memo_size):
+            cache_st.clear()
+            cache_ts.clear()
 
         # Value P(s|t) = pi(avg(w(si|ti)))
-        weight_st = defaultdict(lambda: [])
-        weight_ts = defaultdict(lambda: [])
-        src_lst,tgt_lst = [],[]
+        weight_st = [[] for idx in phrase_src]
+        weight_ts = [[] for idx in phrase_tgt]
         for src_id,tgt_id in alignments:
-            weight_st[src_id].append(float(self.word_pairs_e2f[phrase_src[src_id]][phrase_tgt[tgt_id]])/self.word_count_f[phrase_tgt[tgt_id]])
-            weight_ts[tgt_id].append(float(self.word_pairs_e2f[phrase_src[src_id]][phrase_tgt[tgt_id]])/self.word_count_e[phrase_src[src_id]])
-            src_lst.append(src_id)
-            tgt_lst.append(tgt_id)
-        # Handle the unaligned words
-        for idx in range(len(phrase_src)):
-            if idx not in src_lst:
-                weight_st[idx].append(float(self.word_pairs_e2f[phrase_src[idx]][b'NULL'])/self.word_count_f[b'NULL'])
-        for idx in range(len(phrase_tgt)):
-            if idx not in tgt_lst:
-                weight_ts[idx].append(float(self.word_pairs_e2f[b'NULL'][phrase_tgt[idx]])/self.word_count_e[b'NULL'])
-
-        # Compute the lexical
+            e,f = phrase_src[src_id],phrase_tgt[tgt_id]
+            key = e << 32 | f
+            prob = cache_st.get(key)
+            if (prob is None):
+                prob = cache_st[key] = float(pairs.get(e,f))/self.word_count_f[f]
+            weight_st[src_id].append(prob)
+            prob = cache_ts.get(key)
+            if (prob is None):
+                prob = cache_ts[key] = float(pairs.get(e,f))/self.word_count_e[e]
+            weight_ts[tgt_id].append(prob)
+
+        # Compute the lexical, the unaligned words are aligned to NULL
         lex_st = 1.0
         lex_ts = 1.0
-        for src_id,val_lst in weight_st.iteritems():
+        for idx,val_lst in enumerate(weight_st):
+            if (not val_lst):
+                key = phrase_src[idx] << 32 | NULL_ID
+                prob = cache_st.get(key)
+                if (prob is None):
+                    prob = cache_st[key] = float(pairs.get(phrase_src[idx],NULL_ID))/self.word_count_f[NULL_ID]
+                val_lst.append(prob)
             lex_st *= sum(val_lst)/len(val_lst)
-        for tgt_id,val_lst in weight_ts.iteritems():
+        for idx,val_lst in enumerate(weight_ts):
+            if (not val_lst):
+                key = NULL_ID << 32 | phrase_tgt[idx]
+                prob = cache_ts.get(key)
+                if (prob is None):
+                    prob = cache_ts[key] = float(pairs.get(NULL_ID,phrase_tgt[idx]))/self.word_count_e[NULL_ID]
+                val_lst.append(prob)
             lex_ts *= sum(val_lst)/len(val_lst)
 
         return lex_st, lex_ts
@@ -145,16 +649,17 @@ class Moses:
             output_lex_count_f2e = handle_file("{0}{1}.{2}.{3}".format(path,bridge,"count",'f2e'), 'open', mode='w')
 
         count = 0
-        for e,tgt_hash in self.word_pairs_e2f.iteritems():
-            for f,val in tgt_hash.iteritems():
-                if not count%100000:
-                    sys.stderr.write(str(count)+'...')
-                count+=1
-                if flag:
-                    output_lex_count_e2f.write(b"%s %s %d %d\n" %(f,e,val,self.word_count_e[e]))
-                    output_lex_count_f2e.write(b"%s %s %d %d\n" %(e,f,val,self.word_count_f[f]))
-                output_lex_prob_e2f.write(b"%s %s %.7f\n" %(f,e,float(val)/self.word_count_e[e]))
-                output_lex_prob_f2e.write(b"%s %s %.7f\n" %(e,f,float(val)/self.word_count_f[f]))
+        words_e,words_f = self.vocab_e.words,self.vocab_f.words
+        for e_id,f_id,val in self.word_pairs_e2f:
+            if not count%100000:
+                sys.stderr.write(str(count)+'...')
+            count+=1
+            e,f = words_e[e_id],words_f[f_id]
+            if flag:
+                output_lex_count_e2f.write(b"%s %s %d %d\n" %(f,e,val,self.word_count_e[e_id]))
+                output_lex_count_f2e.write(b"%s %s %d %d\n" %(e,f,val,self.word_count_f[f_id]))
+            output_lex_prob_e2f.write(b"%s %s %.7f\n" %(f,e,float(val)/self.word_count_e[e_id]))
+            output_lex_prob_f2e.write(b"%s %s %.7f\n" %(e,f,float(val)/self.word_count_f[f_id]))
 
         handle_file("{0}{1}.{2}".format(path,bridge,'e2f'),'close',output_lex_prob_e2f,mode='w')
         handle_file("{0}{1}.{2}".format(path,bridge,'f2e'),'close',output_lex_prob_f2e,mode='w')
@@ -163,88 +668,19 @@ class Moses:
             handle_file("{0}{1}.{2}.{3}".format(path,bridge,"count",'f2e'),'close',output_lex_count_f2e,mode='w')
         sys.stderr.write("Done\n")
 
-    def _process_lexical_count_f(self,tempdir=None):
-        ''' compute the count of target phrase, then write them down in format: src ||| tgt ||| count
-            sort the new file
-        '''
-        sys.stderr.write("\nProcess lexical count target: ")
-        outsrc_file = "{0}/{1}.{2}".format(tempdir,"lexical_count","fe2f")
-        outsrc = handle_file(outsrc_file, 'open', mode='w')
-        if (not self.phrase_count_f): # do nothing for nothing
-            sys.stderr.write("The phrase count is empty\n")
-            return None
-        count_tgt,key_tgt,reserve_lines = 0,None,[]
-        count = 0
-        for line in self.phrase_count_f:
-            if not count%1000000:
-                sys.stderr.write(str(count)+"...")
-            count+=1
-            line = line.strip().split(b' ||| ')
-            if (key_tgt and key_tgt != line[0]):
-                for l in reserve_lines:
-                    outsrc.write(b"%s ||| %s ||| %i\n" %(l,key_tgt,count_tgt))
-                reserve_lines,count_tgt = [],0
-            count_tgt += int(line[2])
-            key_tgt=line[0]
-            reserve_lines.append(line[1])
-        if (count_tgt):
-            for l in reserve_lines:
-                outsrc.write(b"%s ||| %s ||| %i\n" %(l,key_tgt,count_tgt))
-        handle_file(outsrc_file, 'close', outsrc, mode='w')
-        sys.stderr.write("Remove temporary target compact file {0}\n".format(self.phrase_count_f.name))
-        os.remove(self.phrase_count_f.name)
-        self.phrase_count_f = None
-        # sort the lexical count by source
-        src_sort_file = sort_file(outsrc_file,tempdir=tempdir)
-        sys.stderr.write("Remove unsorted target compact file {0}\n".format(outsrc_file))
-        os.remove(outsrc_file)
-
-        return src_sort_file
-
-
-    def _process_lexical_count_e(self,phrasefile,tempdir=None):
-        ''' compute the count of source phrase, then write them down in the same format: src ||| tgt ||| count
-            sort the new file
-        '''
-        sys.stderr.write("Process lexical count source: ")
-        outsrc_file = "{0}/{1}.{2}".format(tempdir,"lexical_count","ee2f")
-        outsrc = handle_file(outsrc_file, 'open', mode='w')
-        #insrc = handle_file(phrasefile,'open',mode='r')
-        if (not phrasefile): # do nothing for nothing
-            sys.stderr.write("The phrase count is empty\n")
-            return None
-        count_src,key_src,reserve_lines = 0,None,[]
-        count = 0
-        for line in phrasefile:
-            if not count%1000000:
-                sys.stderr.write(str(count)+"...")
-            count+=1
-            line = _load_line(line)
-            if (key_src and key_src != line[0]):
-                for l in reserve_lines:
-                    outsrc.write(b"%s ||| %s ||| %i\n" %(key_src,l,count_src))
-                reserve_lines,count_src = [],0
-            count_src += int(line[4][2])
-            key_src=line[0]
-            reserve_lines.append(line[1])
-        if (count_src):
-            for l in reserve_lines:
-                outsrc.write(b"%s ||| %s ||| %i\n" %(key_src,l,count_src))
-        handle_file(outsrc_file, 'close', outsrc, mode='w')
-        sys.stderr.write("No need for re-sorting the phrase\n")
-        phrasefile.seek(0)
-        # sort the lexical count by source
-        # no need to be sort
-        #src_sort_file = sort_file(outsrc_file,tempdir=tempdir)
-        return handle_file(outsrc_file, 'open', mode='r')
-
-
-
 # --------------------------------------------------------------------------
 # Section 3: A set of global functions to suppport multi-threading
 # --------------------------------------------------------------------------
-def _glob_get_lexical(word_pairs_e2f,word_count_e,word_count_f,path,bridge,flag):
+def _glob_report_memory(name):
+    ''' Report the peak memory of the current process
+    '''
+    if resource is not None:
+        # kilobytes on Linux
+        sys.stderr.write("Peak memory of {0}: {1} MB\n".format(name, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//1024))
+
+def _glob_get_lexical(shared_counts,path,bridge,flag):
     ''' global function to write the  lexical file
+        shared_counts are the counts of pairs of ids of the vocabularies (SharedCounts)
     '''
     sys.stderr.write("\nWrite the lexical files ")
     bridge=flag
@@ -255,92 +691,139 @@ def _glob_get_lexical(word_pairs_e2f,word_count_e,word_count_f,path,bridge,flag)
         output_lex_count_f2e = handle_file("{0}/{1}.{2}.{3}".format(path,bridge,"count",'f2e'), 'open', mode='w')
 
         count = 0
-        for e,tgt_hash in word_pairs_e2f.iteritems():
-            for f,val in tgt_hash.iteritems():
-                if not count%100000:
-                    sys.stderr.write(str(count)+'...')
-                count+=1
-                output_lex_count_e2f.write(b"%s %s %d %d\n" %(f,e,val,word_count_e[e]))
-                output_lex_count_f2e.write(b"%s %s %d %d\n" %(e,f,val,word_count_f[f]))
-                output_lex_prob_e2f.write(b"%s %s %.7f\n" %(f,e,float(val)/word_count_e[e]))
-                output_lex_prob_f2e.write(b"%s %s %.7f\n" %(e,f,float(val)/word_count_f[f]))
+        words_e,words_f = shared_counts.words('e'),shared_counts.words('f')
+        word_count_e,word_count_f = shared_counts.word_counts('e'),shared_counts.word_counts('f')
+        for e_id,f_id,val in shared_counts.pairs():
+            if not count%100000:
+                sys.stderr.write(str(count)+'...')
+            count+=1
+            e,f = words_e[e_id],words_f[f_id]
+            output_lex_count_e2f.write(b"%s %s %d %d\n" %(f,e,val,word_count_e[e_id]))
+            output_lex_count_f2e.write(b"%s %s %d %d\n" %(e,f,val,word_count_f[f_id]))
+            output_lex_prob_e2f.write(b"%s %s %.7f\n" %(f,e,float(val)/word_count_e[e_id]))
+            output_lex_prob_f2e.write(b"%s %s %.7f\n" %(e,f,float(val)/word_count_f[f_id]))
 
         handle_file("{0}{1}.{2}".format(path,bridge,'e2f'),'close',output_lex_prob_e2f,mode='w')
         handle_file("{0}{1}.{2}".format(path,bridge,'f2e'),'close',output_lex_prob_f2e,mode='w')
         handle_file("{0}{1}.{2}.{3}".format(path,bridge,"count",'e2f'),'close',output_lex_count_e2f,mode='w')
         handle_file("{0}{1}.{2}.{3}".format(path,bridge,"count",'f2e'),'close',output_lex_count_f2e,mode='w')
     sys.stderr.write("Done\n")
+    _glob_report_memory("the lexical writer")
     return 1
 
-def _glob_process_lexical_count_f(phrase_count_f,tempdir=None):
-    ''' compute the count of target phrase, then write them down in format: src ||| tgt ||| count
-        sort the new file
+_shard_triangulator = None
+
+def _glob_init_shard(triangulator):
+    ''' keep the triangulator of the parent process in a worker of the shard pool
     '''
-    sys.stderr.write("\nProcess lexical count target: ")
-    outsrc_file = "{0}/{1}.{2}".format(tempdir,"lexical_count","fe2f")
-    outsrc = handle_file(outsrc_file, 'open', mode='w')
-    if (not phrase_count_f): # do nothing for nothing
-        sys.stderr.write("The phrase count is empty\n")
-        return None
-    count_tgt,key_tgt,reserve_lines = 0,None,[]
-    count = 0
-    for line in phrase_count_f:
-        if not count%1000000:
-            sys.stderr.write(str(count)+"...")
-        count+=1
-        line = line.strip().split(b' ||| ')
-        if (key_tgt and key_tgt != line[0]):
-            for l in reserve_lines:
-                outsrc.write(b"%s ||| %s ||| %i\n" %(l,key_tgt,count_tgt))
-            reserve_lines,count_tgt = [],0
-        count_tgt += int(line[2])
-        key_tgt=line[0]
-        reserve_lines.append(line[1])
-    if (count_tgt):
-        for l in reserve_lines:
-            outsrc.write(b"%s ||| %s ||| %i\n" %(l,key_tgt,count_tgt))
-    handle_file(outsrc_file, 'close', outsrc, mode='w')
-    sys.stderr.write("Remove temporary target compact file {0}\n".format(phrase_count_f.name))
-    os.remove(phrase_count_f.name)
-    phrase_count_f = None
-    # sort the lexical count by source
-    src_sort_file = sort_file_fix(outsrc_file,'phrase_count.f',tempdir=tempdir)
-    sys.stderr.write("Remove unsorted target compact file {0}\n".format(outsrc_file))
-    os.remove(outsrc_file)
-    return 1
+    global _shard_triangulator
+    _shard_triangulator = triangulator
 
-def _glob_process_lexical_count_e(phrasefile,tempdir=None):
-    ''' compute the count of source phrase, then write them down in the same format: src ||| tgt ||| count
-        sort the new file
+def _glob_triangulate_shard(shard):
+    ''' global function to triangulate one shard of the pivot-sorted phrase tables
+        It returns the name of the shard output file and the word and phrase counts of the shard
     '''
-    sys.stderr.write("Process lexical count source: ")
-    outsrc_file = "{0}/{1}.{2}".format(tempdir,"phrase_count","e")
-    outsrc = handle_file(outsrc_file, 'open', mode='w')
-    #insrc = handle_file(phrasefile,'open',mode='r')
-    if (not phrasefile): # do nothing for nothing
-        sys.stderr.write("The phrase count is empty\n")
-        return None
-    count_src,key_src,reserve_lines = 0,None,[]
-    count = 0
-    for line in phrasefile:
-        if not count%1000000:
-            sys.stderr.write(str(count)+"...")
-        count+=1
-        line = _load_line(line)
-        if (key_src and key_src != line[0]):
-            for l in reserve_lines:
-                outsrc.write(b"%s ||| %s ||| %i\n" %(key_src,l,count_src))
-            reserve_lines,count_src = [],0
-        count_src += int(line[4][2])
-        key_src=line[0]
-        reserve_lines.append(line[1])
-    if (count_src):
-        for l in reserve_lines:
-            outsrc.write(b"%s ||| %s ||| %i\n" %(key_src,l,count_src))
-    handle_file(outsrc_file, 'close', outsrc, mode='w')
-    sys.stderr.write("No need for re-sorting the phrase\n")
-    phrasefile.seek(0)
-    return 1
+    idx, filename1, range1, records1, filename2, range2, records2 = shard
+    triangulator = _shard_triangulator
+    triangulator.moses_interface = Moses(triangulator.number_of_features,triangulator.tempdir,triangulator.memory_limit)
+    triangulator.phrase_match = defaultdict(lambda: []*3)
+    triangulator.aggregated, triangulator.aggregated_size, triangulator.aggregated_runs = {}, 0, []
+    triangulator.stats = defaultdict(long)
+
+    model1 = (_open_shard(filename1,range1,records1),1,1)
+    model2 = (_open_shard(filename2,range2,records2),1,2)
+    outfile = "{0}.shard.{1}".format(triangulator.output_file,idx)
+    output_object = handle_file(outfile, 'open', mode='w')
+    triangulator._phrasetable_traversal(model1=model1, model2=model2, prev_line1=None, prev_line2=None, deci=0, output_object=output_object)
+    if (triangulator.fused):
+        # the runs of all shards are merged by the parent process
+        triangulator._spill_aggregated()
+    handle_file(outfile, 'close', output_object, mode='w')
+    model1[0].close()
+    model2[0].close()
+
+    return (outfile, triangulator.moses_interface._export_counts(), triangulator.aggregated_runs, dict(triangulator.stats))
+
+def _glob_hash_shard(shard):
+    ''' global function to look up a byte range of the larger phrase table in the hash join,
+        see Triangulate_TMs._hash_join
+        It returns like _glob_triangulate_shard
+    '''
+    idx, filename, byte_range, records, large = shard
+    triangulator = _shard_triangulator
+    triangulator.moses_interface = Moses(triangulator.number_of_features,triangulator.tempdir,triangulator.memory_limit)
+    triangulator.aggregated, triangulator.aggregated_size, triangulator.aggregated_runs = {}, 0, []
+    triangulator.stats = defaultdict(long)
+
+    fileobj = _open_shard(filename,byte_range,records)
+    lines = fileobj
+    if (triangulator._inverts(large) and not records):
+        lines = _inverted_lines(lines)
+    outfile = "{0}.shard.{1}".format(triangulator.output_file,idx)
+    output_object = handle_file(outfile, 'open', mode='w')
+    triangulator._hash_traversal(lines, large, output_object)
+    if (triangulator.fused):
+        triangulator._spill_aggregated()
+    handle_file(outfile, 'close', output_object, mode='w')
+    fileobj.close()
+
+    return (outfile, triangulator.moses_interface._export_counts(), triangulator.aggregated_runs, dict(triangulator.stats))
+
+def _glob_prepare_table(table):
+    ''' global function to prepare an input phrase table for the join: invert it into a pivot-sorted
+        file (see _inverted_lines) and/or encode it into binary records
+        With a cache (TableCache), the prepared table is kept and reused
+        It returns the name of the prepared table
+    '''
+    filename, invert, records, tempdir, cache = table
+    kind = 'inverted.records' if (invert and records) else ('inverted' if invert else 'records')
+    newname = None
+    if (cache):
+        cached = cache.get(filename, kind)
+        if cached:
+            sys.stderr.write("Reuse the prepared model {0}: {1}\n".format(filename, cached))
+            return cached
+        # renamed once it is complete
+        newname = cache.partial()
+
+    sys.stderr.write("{0} model {1} ...".format('Inverse' if invert else 'Encode', filename))
+    model = handle_file(filename,'open',mode='r')
+    lines = model
+    if (invert):
+        lines = _inverted_lines(lines)
+    if (records):
+        lines = (_pack_line(_load_line(line)) for line in lines)
+    if (invert):
+        # the inverted lines are sorted without an unsorted temporary file
+        outfile = sort_stream(lines,newname=newname,tempdir=tempdir,records=records)
+    else:
+        # the lines are encoded in their order
+        outfile = open(newname,'wb') if newname else NamedTemporaryFile(delete=False,dir=tempdir)
+        for line in lines:
+            _write_record(outfile,line)
+    outfile.close()
+    handle_file(filename,'close',model,mode='r')
+    sys.stderr.write("Done\n")
+    if (cache):
+        return cache.put(newname, filename, kind)
+    return outfile.name
+
+def _glob_triangulate_pivot(triangulator,result_file):
+    ''' global function to triangulate the phrase tables of one pivot language
+        The name of its sorted output and its word and phrase counts are pickled into result_file
+    '''
+    triangulator.triangulate_standard()
+    if (triangulator.fused):
+        # the combined phrase pairs are already sorted
+        outfile = triangulator.output_file
+    else:
+        sorted_file = sort_file(triangulator.output_file,tempdir=triangulator.tempdir,records=True)
+        os.remove(triangulator.output_file)
+        outfile = sorted_file.name
+        sorted_file.close()
+    with open(result_file,'wb') as result:
+        pickle.dump((outfile, triangulator.moses_interface._export_counts()), result, 2)
+    _glob_report_memory("the triangulation of {0} and {1}".format(triangulator.model1, triangulator.model2))
 
 # --------------------------------------------------------------------------
 # Section 4: Merge identical phrase pairs in the duplicate ttable
@@ -359,7 +842,8 @@ class Merge_TM():
                       action="features_based",
                       moses_interface=None,
                       weight='summation',
-                      tempdir=None):
+                      tempdir=None,
+                      max_targets=None):
         self.mode = mode
         self.model = model # the model file
         self.output_file = output_file
@@ -372,27 +856,25 @@ class Merge_TM():
         self.weight=weight
         self.tempdir=tempdir
 
-        # Parallelism, hack-ish way to run parallel
-        # Damn python
-        pool = Pool(processes=3)
-        # get the path
+        # Keep the best target phrases of each source phrase, see _write_line
+        self.max_targets = max_targets
+        self.source_lines = []
+        self.pruned_targets = 0
+
+        # Write the lexical files in one writer process, which reads the word counts
+        # from SharedCounts instead of the copy-on-write pages of the Python objects
+        # It runs while the phrase pairs are merged and is joined by _combine_TM
         bridge = "/lex" + os.path.basename(self.output_file).replace("phrase-table","").replace(".gz", "") # create the lexical associated with phrase table
-        #self.moses_interface._get_lexical(os.path.dirname(os.path.realpath(self.output_file)), bridge,flag=0)
-        lexc = Process(target=_glob_get_lexical, args=[self.moses_interface.word_pairs_e2f,self.moses_interface.word_count_e,self.moses_interface.word_count_f,os.path.dirname(os.path.realpath(self.output_file)), bridge,self.output_lexical])
-        # handle the phrase count
-        #self.phrase_count_f = self.moses_interface._process_lexical_count_f(tempdir=self.tempdir)
-        lexf = Process(target=_glob_process_lexical_count_f, args=[self.moses_interface.phrase_count_f,self.tempdir])
-        #self.phrase_count_e = self.moses_interface._process_lexical_count_e(self.model,tempdir=self.tempdir)
-        lexe = Process(target=_glob_process_lexical_count_e, args=[self.model,self.tempdir])
-        for p in [lexc,lexf,lexe]:
-            p.start()
-            sys.stderr.write(" --- process started at: {0} --- ".format(datetime.now()))
-        for p in [lexc,lexf,lexe]:
-            p.join()
-            sys.stderr.write("--- process joined at: {0} --- ".format(datetime.now()))
-
-        self.phrase_count_e=handle_file(os.path.normpath("{0}/{1}".format(self.tempdir,"phrase_count.e")),'open',mode='r')
-        self.phrase_count_f=handle_file(os.path.normpath("{0}/{1}".format(self.tempdir,"phrase_count.f")),'open',mode='r')
+        self.shared_counts = SharedCounts(self.moses_interface)
+        self.lexical_writer = Process(target=_glob_get_lexical, args=[self.shared_counts,os.path.dirname(os.path.realpath(self.output_file)), bridge,self.output_lexical])
+        self.lexical_writer.start()
+        sys.stderr.write(" --- process started at: {0} --- ".format(datetime.now()))
+
+        # the phrase counts were summed up during triangulation, see Triangulate_TMs._update_moses
+        self.phrase_count_e = self.moses_interface.phrase_count_e
+        self.phrase_count_f = self.moses_interface.phrase_count_f
+        self.phrase_count_e.finalize()
+        self.phrase_count_f.finalize()
 
     def _combine_TM(self,flag=False,prev_line=None):
         '''
@@ -420,48 +902,72 @@ class Merge_TM():
             self._combine_lines = self._combine_sum
             self._recompute_features = self._recompute_features_Cohn
         self._line_traversal(flag,prev_line,output_object)
+        self._flush_source(output_object)
+        if (self.max_targets):
+            sys.stderr.write("Pruned {0} phrase pairs beyond {1} targets per source phrase\n".format(self.pruned_targets, self.max_targets))
         handle_file(self.output_file,'close',output_object,mode='w')
+        self.phrase_count_e.close()
+        self.phrase_count_f.close()
+        self.lexical_writer.join()
+        sys.stderr.write("--- process joined at: {0} --- ".format(datetime.now()))
+        self.shared_counts.close()
+        _glob_report_memory("the main process")
 
     def _parallel_traversal(self,flag=False,prev_line=None,output_object=None):
-        ''' Travel through the phrase-table and the phrase compact files simultaneously
+        ''' Travel through the phrase-table, looking up the counts of its phrases
             The features of new ttable are computed on the fly
         '''
         count = 0
-        for line,phrase_count_f,phrase_count_e in izip(self.model,self.phrase_count_f,self.phrase_count_e):
+        for line in self.model:
             if not count%1000000:
                 sys.stderr.write(str(count)+'...')
             count+=1
 
-            line = _load_line(line)
-            phrase_count_ff = phrase_count_f.strip().split(b' ||| ')
-            phrase_count_ee = phrase_count_e.strip().split(b' ||| ')
-
-            if (line[0] != phrase_count_ff[0] or line[1] != phrase_count_ff[1]):
-                sys.exit("Mismatch between phrase table and count table")
-            else:
-                line[4][0] = long(phrase_count_ff[2])
-                line[4][1] = long(phrase_count_ee[2])
+            line = PhraseRecord(line)
+            line[4][0] = self.phrase_count_f[line[1]]
+            line[4][1] = self.phrase_count_e[line[0]]
 
             if (prev_line):
-                if (line[0] == prev_line[0] and line[1] == prev_line[1]):
+                if (line.key == prev_line.key):
                     # combine current sentence to previous sentence, return previous sentence
                     prev_line = self._combine_lines(prev_line, line)
                     continue
                 else:
                     prev_line = self._recompute_features(prev_line)
                     # when you get out of the identical blog, start writing
-                    outline = _write_phrasetable_file(prev_line)
-                    output_object.write(outline)
+                    self._write_line(prev_line,output_object)
                     prev_line = line
             else:
                 # the first position
                 prev_line = line
         if (len(prev_line)):
             prev_line = self._recompute_features(prev_line)
-            outline = _write_phrasetable_file(prev_line)
-            output_object.write(outline)
+            self._write_line(prev_line,output_object)
         sys.stderr.write("Done\n")
 
+    def _write_line(self,line,output_object):
+        ''' Write a merged line
+            With max_targets, the lines of a source phrase are kept until the source phrase changes
+        '''
+        if (not self.max_targets):
+            output_object.write(_write_phrasetable_file(line))
+            return
+        if (self.source_lines and self.source_lines[0][0] != line[0]):
+            self._flush_source(output_object)
+        self.source_lines.append(line)
+
+    def _flush_source(self,output_object):
+        ''' Write the max_targets best lines of the kept source phrase by p(t|s), in their original order
+        '''
+        lines = self.source_lines
+        if (self.max_targets and len(lines) > self.max_targets):
+            kept = heapq.nlargest(self.max_targets, range(len(lines)), key=lambda i: lines[i][2][2])
+            self.pruned_targets += len(lines) - len(kept)
+            lines = [lines[i] for i in sorted(kept)]
+        for line in lines:
+            output_object.write(_write_phrasetable_file(line))
+        self.source_lines = []
+
     def _recompute_features_Cohn(self,line):
         ''' The features have already been estimated in the previous step
         '''
@@ -573,7 +1079,17 @@ class Triangulate_TMs():
                       lang_src=None,
                       lang_target=None,
                       output_lexical=None,
-                      write_phrase_penalty=None):
+                      write_phrase_penalty=None,
+                      jobs=1,
+                      fused=False,
+                      max_pivot_fanout=None,
+                      min_prob=None,
+                      min_count=None,
+                      memory_limit=None,
+                      incremental=None,
+                      cache=None,
+                      cache_records=False,
+                      join='auto'):
 
         self.mode = mode
         self.model1=model1
@@ -585,6 +1101,46 @@ class Triangulate_TMs():
         self.loaded = defaultdict(int)
         self.output_lexical = output_lexical
         self.tempdir=tempdir
+        self.jobs = int(jobs)
+        self.weight = weight
+
+        # Identical phrase pairs combined in memory, see _aggregate_line
+        self.fused = fused
+        self.aggregated = {}
+        self.aggregated_size = 0
+        self.aggregated_runs = []
+
+        # Keep the best phrases of each side of a pivot phrase, see _prune_fanout
+        self.max_pivot_fanout = max_pivot_fanout
+        self.stats = defaultdict(long)
+
+        # Drop improbable phrase pairs, see _below_threshold
+        self.min_prob = min_prob
+        self.min_count = min_count
+
+        # Memory of the phrase counts before they are spilled to disk, see PhraseCounts
+        self.memory_limit = memory_limit
+
+        # The directory of the previous triangulation, see IncrementalState
+        self.incremental_dir = incremental
+        self.incremental = None
+        if (incremental and fused):
+            raise TypeError('Error: --incremental keeps the triangulated phrase pairs of each pivot phrase, it does not work with --fused\n')
+        if (incremental):
+            self.jobs = 1
+
+        # The prepared input phrase tables of previous runs, see TableCache
+        self.cache = TableCache(cache) if cache else None
+        self.cache_records = cache_records
+
+        # The join of the two phrase tables, see _choose_join
+        self.join = join
+        self.hash_index = None
+        if (join == 'hash' and (max_pivot_fanout or incremental)):
+            raise TypeError('Error: the hash join triangulates parts of pivot groups, it does not work with --max-pivot-fanout or --incremental\n')
+
+        # Composed word alignments of pairs of alignment fields, see _compose_alignments
+        self.alignment_memo = {}
 
         # It's possible to have the input in several modes: stp or tps
         self.inverted = None
@@ -606,7 +1162,7 @@ class Triangulate_TMs():
                 self.estimate_counts = get_geometric_mean
 
         # The moses interface is to keep word counts
-        self.moses_interface = Moses(4)
+        self.moses_interface = Moses(4,self.tempdir,self.memory_limit)
 
     def triangulate_standard(self,weight=None):
         ''' Triangulating two phrase tables and writing a temporary output file
@@ -616,46 +1172,61 @@ class Triangulate_TMs():
 
         #1: formulate the input phrase tables
         if os.path.isfile(self.model1):
-            model1 = (handle_file(self.model1, 'open', 'r'),1,1)
+            model1 = (_open_table(self.model1),1,1)
         elif os.path.isdir(self.model1):
-            model1 = (handle_file(os.path.join(self.model1,'model','phrase-table'), 'open', 'r'),1,1)
+            model1 = (_open_table(os.path.join(self.model1,'model','phrase-table')),1,1)
         else:
             raise TypeError("The source-pivot phrase table does not exists")
         if os.path.isfile(self.model2):
-            model2 = (handle_file(self.model2, 'open', 'r'),1,2)
+            model2 = (_open_table(self.model2),1,2)
         elif os.path.isdir(self.model2):
-            model2 = (handle_file(os.path.join(self.model2,'model','phrase-table'), 'open', 'r'),1,2)
+            model2 = (_open_table(os.path.join(self.model2,'model','phrase-table')),1,2)
         else:
             raise TypeError("The pivot-target phrase table does not exists")
-        model1, model2 = self._ensure_inverted(model1, model2)
+        large = self._choose_join(model1, model2)
+        if (not large):
+            model1, model2 = self._ensure_inverted(model1, model2)
 
         #2: prepare temporary files
-        outtgt_file = os.path.normpath("{0}/{1}.{2}".format(self.tempdir,"lexical_count","f")) #lexical target count file
-        outsrc_file = os.path.normpath("{0}/{1}.{2}".format(self.tempdir,"lexical_count","e")) # lexical source count file
-        output_tgt = handle_file(outtgt_file, 'open', mode='w') # write one more file in format tgt ||| src ||| count_s+t
-        output_src = handle_file(outsrc_file, 'open', mode='w') # write one more file in format src ||| tgt ||| count_s+t
-        sys.stderr.write("Write compact lexical files: {0} and {1}\n" .format(outtgt_file, outsrc_file))
         output_object = handle_file(self.output_file,'open',mode='w')
+        if (self.incremental_dir):
+            self.incremental = IncrementalState(self.incremental_dir, self._settings())
+            if (self.incremental.counts):
+                self.moses_interface._add_counts(*self.incremental.counts)
 
         #3: Computing and writing new phrase tables
         #   The main function of triangulating phrase pairs
         self._get_features = self._get_features_Cohn
         sys.stderr.write('Incrementally loading and processing phrase tables...')
         # Start process phrase table
-        self.phrase_match = defaultdict(lambda: []*3)
-        self._phrasetable_traversal(model1=model1, model2=model2, prev_line1=None, prev_line2=None, deci=0, output_object=output_object,output_tgt=output_tgt,output_src=output_src)
+        if (large):
+            self._hash_join(model1, model2, large, output_object)
+        elif (self.jobs > 1):
+            self._sharded_traversal(model1=model1, model2=model2, output_object=output_object)
+        else:
+            self.phrase_match = defaultdict(lambda: []*3)
+            self._phrasetable_traversal(model1=model1, model2=model2, prev_line1=None, prev_line2=None, deci=0, output_object=output_object)
+        if (self.fused):
+            self._write_aggregated(output_object)
+        if (self.incremental):
+            self._remove_old_groups()
         sys.stderr.write("Done\n")
+        if (self.max_pivot_fanout):
+            sys.stderr.write("Pivot fanout pruning: {0} of {1} pivot groups, {2} source and {3} target phrases, {4} of {5} phrase pairs\n".format(
+                self.stats['pruned_groups'], self.stats['groups'], self.stats['pruned_src'], self.stats['pruned_tgt'],
+                self.stats['pruned_pairs'], self.stats['pruned_pairs'] + self.stats['pairs']))
+        if (self.min_prob or self.min_count):
+            sys.stderr.write("Threshold filtering: {0} pivot groups skipped, {1} of {2} phrase pairs dropped\n".format(
+                self.stats['filtered_groups'], self.stats['filtered_pairs'], self.stats['pairs']))
 
         #4: Closing and cleaning temporary files
         handle_file(self.output_file,'close',output_object,mode='w')
-        handle_file(outtgt_file,'close',output_tgt,mode='w')
-        handle_file(outsrc_file,'close',output_src,mode='w')
-
-        self.moses_interface.phrase_count_f = sort_file(outtgt_file,tempdir=self.tempdir)
-        sys.stderr.write("Remove unsorted target compact file {0}\n" .format(outtgt_file))
-        os.remove(outtgt_file)
-        self.moses_interface.phrase_count_e = sort_file(outsrc_file,tempdir=self.tempdir)
-        os.remove(outsrc_file)
+        if (self.incremental):
+            stats = self.incremental.stats
+            sys.stderr.write("Incremental triangulation: {0} pivot groups reused, {1} triangulated, {2} removed\n".format(
+                stats['reused'], stats['triangulated'], stats['removed']))
+            self.incremental.save(self.output_file, self.moses_interface)
+            self.incremental = None
 
     def _ensure_inverted(self, model1, model2):
         ''' This function handles the input mode
@@ -663,153 +1234,568 @@ class Triangulate_TMs():
             which consists of pivot->source and pivot->target phrase tables
             It makes sure that the two phrase tables are sorted according
             to pivot phrases
+            With cache_records, the prepared tables are kept as binary records
+            An indexed table is sorted by pivot phrase whatever the mode, see binarize_table
         '''
-        # If the mode is 'pst'
-        if (self.inverted == 'pspt'):
-            return (model1, model2)
-
         models=[]
         if (self.inverted == 'sppt'):
-            models.append(model1)
+            models.append((model1,True))
         elif (self.inverted == 'pstp'):
-            models.append(model2)
+            models.append((model2,True))
         elif (self.inverted == 'sptp'):
-            models.append(model1)
-            models.append(model2)
-        else:
-            # self.inverted = none or whatever
+            models.append((model1,True))
+            models.append((model2,True))
+        if (self.cache and self.cache_records):
+            # the pivot-sorted tables are only encoded
+            inverted = [mod for mod,invert in models]
+            models.extend([(mod,False) for mod in (model1,model2) if mod not in inverted])
+        models = [(mod,invert) for mod,invert in models if not isinstance(mod[0],IndexedTable)]
+        if (not models):
             return (model1, model2)
 
-        for mod in models:
-            outfile = NamedTemporaryFile(delete=False,dir=self.tempdir)
-            output_contr = handle_file(outfile.name, 'open', mode='w')
-            sys.stderr.write("Inverse model {0} > {1} ...".format(mod[0], outfile.name))
-            count=0
-            for line in mod[0]:
-                if not count%100000:
-                    sys.stderr.write(str(count)+'...')
-                count+=1
-
-                line = _load_line(line)
-                # reversing src,tgt
-                line[0],line[1] = line[1],line[0]
-                # reverse probability
-                line[2][0],line[2][2] = line[2][2],line[2][0]
-                # reverse alignment
-                for lid in range(len(line[3])):
-                    line[3][lid][0],line[3][lid][1] =  line[3][lid][1],line[3][lid][0]
-                # reverse count
-                line[4][0],line[4][1] = line[4][0],line[4][1]
-
-                outline = _write_phrasetable_file(line)
-                output_contr.write(outline)
-            handle_file(outfile.name,'close',output_contr,mode='w')
-            tmpfile = sort_file(outfile.name,tempdir=self.tempdir)
-            sys.stderr.write("Remove file: {0}\n" .format(outfile.name))
-            os.remove(outfile.name)
+        # the tables are prepared by file name, in parallel for sptp
+        records = bool(self.cache and self.cache_records)
+        tables = []
+        for mod,invert in models:
+            tables.append((mod[0].name, invert, records, self.tempdir, self.cache))
+            mod[0].close()
+        if (len(tables) > 1):
+            pool = Pool(processes=len(tables))
+            prepared = pool.map(_glob_prepare_table, tables)
+            pool.close()
+            pool.join()
+        else:
+            prepared = [_glob_prepare_table(table) for table in tables]
+
+        for (mod,invert),filename in zip(models,prepared):
+            tmpfile = open(filename,'rb')
+            if (records):
+                tmpfile = _RecordFile(tmpfile)
             if (mod[2] == model1[2]):
                 model1 = (tmpfile, model1[1], model1[2])
             elif (mod[2] == model2[2]):
                 model2 = (tmpfile, model2[1], model2[2])
-            sys.stderr.write("Done\n")
         return (model1, model2)
 
-    def _phrasetable_traversal(self,model1,model2,prev_line1,prev_line2,deci,output_object,output_tgt,output_src):
-        ''' A non-recursive way to read two models at the same time
+    def _sharded_traversal(self,model1,model2,output_object):
+        ''' Split the two pivot-sorted phrase tables into byte ranges starting at the same pivot phrases,
+            triangulate each pair of ranges in a separate process,
+            then concatenate the outputs in order and add up the word counts
+        '''
+        filename1, remove1 = self._ensure_seekable(model1[0])
+        filename2, remove2 = self._ensure_seekable(model2[0])
+        records1 = isinstance(model1[0], (_RecordFile,IndexedTable))
+        records2 = isinstance(model2[0], (_RecordFile,IndexedTable))
+        seek = self._seek_side(model1, model2)
+        if (seek == 1):
+            # only the scanned table is cut, each shard looks up the whole indexed table
+            ranges = [(None,range2) for range2 in _cut_table(filename2, self.jobs, records2)]
+        elif (seek == 2):
+            ranges = [(range1,None) for range1 in _cut_table(filename1, self.jobs, records1)]
+        else:
+            ranges = _get_shards(filename1, filename2, self.jobs, records1, records2)
+        shards = []
+        for idx,(range1,range2) in enumerate(ranges):
+            shards.append((idx, filename1, range1, records1, filename2, range2, records2))
+        self._run_shards(_glob_triangulate_shard, shards, output_object)
+
+        for filename,remove in [(filename1,remove1),(filename2,remove2)]:
+            if remove:
+                sys.stderr.write("Remove file: {0}\n" .format(filename))
+                os.remove(filename)
+
+    def _run_shards(self,function,shards,output_object):
+        ''' Triangulate the shards in a pool of processes,
+            then concatenate the outputs in order and add up the word counts
+        '''
+        sys.stderr.write("Triangulate {0} shards with {1} processes\n".format(len(shards), self.jobs))
+        pool = Pool(processes=self.jobs, initializer=_glob_init_shard, initargs=[self])
+        # imap keeps the order of the shards
+        for outfile, word_counts, runs, stats in pool.imap(function, shards):
+            shard_object = handle_file(outfile, 'open', mode='r')
+            shutil.copyfileobj(shard_object, output_object)
+            handle_file(outfile, 'close', shard_object, mode='r')
+            os.remove(outfile)
+            self.moses_interface._add_counts(*word_counts)
+            self.aggregated_runs.extend(runs)
+            for key,val in stats.iteritems():
+                self.stats[key] += val
+        pool.close()
+        pool.join()
+
+    def _ensure_seekable(self, fileobj):
+        ''' Shards are byte ranges of uncompressed files,
+            a compressed phrase table is decompressed into the temporary directory (or the cache)
+            Return the file name and whether it is a temporary file
+        '''
+        if isinstance(fileobj, (_RecordFile,IndexedTable)):
+            return (fileobj.name, False)
+        if not isinstance(fileobj, _ThreadedReader):
+            return (fileobj.name, False)
+        if (self.cache):
+            cached = self.cache.get(fileobj.name, 'decompressed')
+            if cached:
+                sys.stderr.write("Reuse the decompressed model {0}: {1}\n".format(fileobj.name, cached))
+                fileobj.close()
+                return (cached, False)
+            outfile = open(self.cache.partial(),'wb')
+        else:
+            outfile = NamedTemporaryFile(delete=False,dir=self.tempdir)
+        sys.stderr.write("Decompress {0} > {1} ...".format(fileobj.name, outfile.name))
+        shutil.copyfileobj(fileobj, outfile)
+        outfile.close()
+        sys.stderr.write("Done\n")
+        if (self.cache):
+            return (self.cache.put(outfile.name, fileobj.name, 'decompressed'), False)
+        return (outfile.name, True)
+
+    def _phrasetable_traversal(self,model1,model2,prev_line1,prev_line2,deci,output_object):
+        ''' A merge join of the two pivot-sorted models, group by group of pivot phrases
+            Only the groups whose pivot phrase occurs in both models are parsed
             Notes: In moses phrase table, the longer phrase appears earlier than the short phrase
         '''
-        line1 =  _load_line(model1[0].readline())
-        line2 =  _load_line(model2[0].readline())
+        seek = self._seek_side(model1, model2)
+        if (seek):
+            return self._seek_traversal(model1, model2, seek, output_object)
+        file1 = _open_mapped(model1[0])
+        file2 = _open_mapped(model2[0])
+        reader1 = PivotGroupReader(file1)
+        reader2 = PivotGroupReader(file2)
         count = 0
-        while(1):
+        while (reader1.key is not None and reader2.key is not None):
             if not count%1000000:
                 sys.stderr.write(str(count)+'...')
             count+=1
 
-            # Pivot phrases are identical
-            if (self.phrase_match[0]):
-                if (line1 and line1[0] == self.phrase_match[0]):
-                    self.phrase_match[1].append(line1)
-                    line1 =  _load_line(model1[0].readline())
-                    continue
-                elif (line2 and line2[0] == self.phrase_match[0]):
-                    self.phrase_match[2].append(line2)
-                    line2 = _load_line(model2[0].readline())
-                    continue
+            # Compare the pivot phrases.
+            # The tables are sorted by whole lines, so the pivot phrases are
+            # compared together with the field separator (see _pivot_key)
+            if (reader1.key < reader2.key):
+                reader1.skip()
+            elif (reader1.key > reader2.key):
+                reader2.skip()
+            else:
+                # Pivot phrases are identical
+                key = reader1.key
+                self.phrase_match[1] = reader1.read()
+                self.phrase_match[2] = reader2.read()
+                self.phrase_match[0] = self.phrase_match[1][0][0]
+                if (self.incremental):
+                    self._triangulate_group(key,output_object)
                 else:
-                    self._combine_and_write(output_object,output_tgt,output_src)
+                    self._combine_and_write(output_object)
+        for fileobj,model in [(file1,model1),(file2,model2)]:
+            if (fileobj is not model[0]):
+                fileobj.close()
+        sys.stderr.write("Finish loading\n")
+        return None
 
-            # End of file
-            if (not line1 or not line2):
-                self._combine_and_write(output_object,output_tgt,output_src)
-                sys.stderr.write("Finish loading\n")
-                return None
+    def _choose_join(self,model1,model2):
+        ''' The larger model (1 or 2) for a hash join, see _hash_join, or None for a merge join
+            With join auto, the hash join is used when the larger model would be inverted and sorted,
+            and the smaller model is hash_ratio times smaller and fits into the sort buffer
+        '''
+        if (self.join == 'merge'):
+            return None
+        sizes = [None, _table_size(model1[0]), _table_size(model2[0])]
+        large = 1 if sizes[1] >= sizes[2] else 2
+        if (self.join == 'hash'):
+            return large
+        if (self.max_pivot_fanout or self.incremental_dir or isinstance((model1,model2)[large-1][0],IndexedTable)):
+            return None
+        if (not self._inverts(large) or sizes[3-large] * hash_ratio > sizes[large]
+                or sizes[3-large] * hash_overhead > sort_buffer_size):
+            return None
+        if (self.cache and self.cache.get((model1,model2)[large-1][0].name, 'inverted.records' if self.cache_records else 'inverted')):
+            # the larger model was inverted and sorted before
+            return None
+        return large
 
-            # Compare the pivot phrases.
-            # An exception if the long phrase contains the short phrase
-            if (not self.phrase_match[0]):
-                if (line1[0] == line2[0]):
-                    self.phrase_match[0] = line1[0]
-                elif (line1[0].startswith(line2[0])):
-                    line1 = _load_line(model1[0].readline())
-                elif (line2[0].startswith(line1[0])):
-                    line2 = _load_line(model2[0].readline())
-                elif (line1[0] < line2[0]):
-                    line1 = _load_line(model1[0].readline())
-                elif (line1[0] > line2[0]):
-                    line2 = _load_line(model2[0].readline())
-
-    def _combine_and_write(self,output_object,output_tgt,output_src):
+    def _inverts(self,model):
+        ''' Whether the model (1 or 2) is inverted in the input mode
+        '''
+        if (model == 1):
+            return self.inverted in ('sppt','sptp')
+        return self.inverted in ('pstp','sptp')
+
+    def _hash_join(self,model1,model2,large,output_object):
+        ''' A join which keeps the pivot groups of the smaller model in memory (see _hash_index)
+            and looks up the lines of the larger model (`large`), which are read unsorted
+            and inverted on the fly, see _hash_traversal
+        '''
+        models = [None,model1,model2]
+        small = 3 - large
+        self.hash_index = self._hash_index(models[small][0], small)
+        sys.stderr.write("Hash join: {0} pivot phrases of {1} in memory, stream {2}\n".format(
+            len(self.hash_index), models[small][0].name, models[large][0].name))
+        fileobj = models[large][0]
+        if (self.jobs > 1):
+            filename, remove = self._ensure_seekable(fileobj)
+            if isinstance(fileobj,IndexedTable):
+                ranges = _cut_table(filename, self.jobs, True)
+            else:
+                ranges = _cut_lines(filename, self.jobs)
+            records = isinstance(fileobj,IndexedTable)
+            shards = [(idx, filename, byte_range, records, large) for idx,byte_range in enumerate(ranges)]
+            self._run_shards(_glob_hash_shard, shards, output_object)
+            if remove:
+                sys.stderr.write("Remove file: {0}\n" .format(filename))
+                os.remove(filename)
+        else:
+            mapped = _open_mapped(fileobj)
+            if (mapped is not fileobj):
+                # the map opens the file itself
+                fileobj.close()
+            lines = mapped
+            if (self._inverts(large) and not isinstance(fileobj,IndexedTable)):
+                lines = _inverted_lines(lines)
+            self._hash_traversal(lines, large, output_object)
+            mapped.close()
+        self.hash_index = None
+
+    def _hash_index(self,fileobj,model):
+        ''' The lines of a model grouped by pivot phrase (see _pivot_key), inverted when the mode says so
+        '''
+        mapped = _open_mapped(fileobj)
+        if (mapped is not fileobj):
+            # the map opens the file itself
+            fileobj.close()
+        lines = mapped
+        if (self._inverts(model) and not isinstance(fileobj,IndexedTable)):
+            lines = _inverted_lines(lines)
+        index = {}
+        for line in lines:
+            key = _raw_pivot_key(line)
+            group = index.get(key)
+            if group is None:
+                index[key] = [line]
+            else:
+                group.append(line)
+        mapped.close()
+        return index
+
+    def _hash_traversal(self,lines,large,output_object):
+        ''' Look up the lines of the larger model, in any order, in the pivot groups of the smaller model
+            The matching lines are collected by pivot phrase up to the sort buffer size,
+            then each pivot phrase is triangulated with the lines collected so far
+        '''
+        index = self.hash_index
+        matched,size = {},0
+        count = 0
+        for line in lines:
+            if not count%1000000:
+                sys.stderr.write(str(count)+'...')
+            count+=1
+
+            key = _raw_pivot_key(line)
+            if key not in index:
+                continue
+            group = matched.get(key)
+            if group is None:
+                matched[key] = [line]
+            else:
+                group.append(line)
+            # the length of the line plus the overhead of a string in a list
+            size += len(line) + 48
+            if (size >= sort_buffer_size):
+                self._hash_flush(matched, large, output_object)
+                matched,size = {},0
+        self._hash_flush(matched, large, output_object)
+        sys.stderr.write("Finish loading\n")
+
+    def _hash_flush(self,matched,large,output_object):
+        ''' Triangulate the collected lines of the larger model with the groups of the smaller model
+        '''
+        index = self.hash_index
+        small = 3 - large
+        for key in sorted(matched):
+            group = index[key]
+            if not isinstance(group[0],PhraseRecord):
+                # parsed once, on the first look up
+                group = index[key] = [PhraseRecord(line) for line in group]
+            self.phrase_match = defaultdict(lambda: []*3)
+            self.phrase_match[large] = [PhraseRecord(line) for line in matched[key]]
+            self.phrase_match[small] = group
+            self.phrase_match[0] = self.phrase_match[1][0][0]
+            self._combine_and_write(output_object)
+
+    def _seek_side(self,model1,model2):
+        ''' The model (1 or 2) to look up by the pivot phrases of the other model, when it is
+            an indexed table (see IndexedTable) and the other model is seek_ratio times smaller,
+            None for a merge join
+        '''
+        for seek,scan in [(1,model2),(2,model1)]:
+            table = (model1,model2)[seek-1][0]
+            if (isinstance(table,IndexedTable) and _table_size(scan[0]) * seek_ratio <= table.size):
+                return seek
+        return None
+
+    def _seek_traversal(self,model1,model2,seek,output_object):
+        ''' A join which reads the groups of one model and looks up their pivot phrases
+            in the index of the other model (`seek`), instead of scanning the whole table
+            The groups are joined in the same order as by the merge join
+        '''
+        models = [None,model1,model2]
+        scan = 3 - seek
+        table = models[seek][0]
+        fileobj = _open_mapped(models[scan][0])
+        if (fileobj is not models[scan][0]):
+            # the map opens the file itself
+            models[scan][0].close()
+        reader = PivotGroupReader(fileobj)
+        sys.stderr.write("Look up the pivot phrases of {0} in {1}\n".format(fileobj.name, table.name))
+        count = 0
+        while (reader.key is not None):
+            if not count%1000000:
+                sys.stderr.write(str(count)+'...')
+            count+=1
+
+            key = reader.key
+            group = table.lookup(key)
+            if (group is None):
+                reader.skip()
+                continue
+            self.phrase_match[scan] = reader.read()
+            self.phrase_match[seek] = group
+            self.phrase_match[0] = self.phrase_match[1][0][0]
+            if (self.incremental):
+                self._triangulate_group(key,output_object)
+            else:
+                self._combine_and_write(output_object)
+        if (fileobj is not models[scan][0]):
+            fileobj.close()
+        sys.stderr.write("Finish loading\n")
+        return None
+
+    def _settings(self):
+        ''' The options which change the triangulated phrase pairs, see IncrementalState
+        '''
+        return (self.action, self.weight, self.estimate_counts.__name__, self.inverted, self.number_of_features,
+                self.max_pivot_fanout, self.min_prob, self.min_count)
+
+    def _triangulate_group(self,key,output_object):
+        ''' Triangulate a pivot group, or copy its records of the previous triangulation
+            when its rows did not change in either phrase table
+        '''
+        state = self.incremental
+        digest = state.digest(self.phrase_match[1], self.phrase_match[2])
+        # the groups left over are removed, see _remove_old_groups
+        group = state.groups.pop(key, None)
+        start = output_object.tell()
+        if (group is not None and group[0] == digest):
+            state.copy_group(group, output_object)
+            state.stats['reused'] += 1
+        else:
+            if (group is not None):
+                self._subtract_records(state.old_records(group))
+            self._combine_and_write(output_object)
+            state.stats['triangulated'] += 1
+        state.new_groups[key] = (digest, start, output_object.tell())
+
+    def _remove_old_groups(self):
+        ''' Subtract the counts of the previous pivot groups which are gone
+        '''
+        state = self.incremental
+        for group in state.groups.itervalues():
+            self._subtract_records(state.old_records(group))
+            state.stats['removed'] += 1
+        state.groups = {}
+        if (state.stats['subtracted']):
+            # the pairs which were only triangulated from changed groups
+            self.moses_interface.word_pairs_e2f.compact()
+
+    def _subtract_records(self,records):
+        ''' Take the phrase pairs of a previous triangulation out of the word and phrase counts
+        '''
+        for record in records:
+            src,tgt,features,word_alignments,word_counts = _unpack_line(record)
+            word_counts[2] = -word_counts[2]
+            self._update_moses(src,tgt,word_alignments,word_counts)
+            self.incremental.stats['subtracted'] += 1
+
+    def _combine_and_write(self,output_object):
         ''' Triangulating two phrases and write the new obtained phrases
         '''
-        for phrase1 in self.phrase_match[1]:
-            for phrase2 in self.phrase_match[2]:
+        phrases1, phrases2 = self._prune_fanout(self.phrase_match[1], self.phrase_match[2])
+        if (self._group_below_threshold(phrases1, phrases2)):
+            self.stats['filtered_groups'] += 1
+            self.stats['filtered_pairs'] += len(phrases1)*len(phrases2)
+            phrases1, phrases2 = [], []
+        group = self._get_group_features(phrases1, phrases2)
+        # the pivot-target alignments indexed by pivot position, see _alignment_index
+        indexes = [None]*len(phrases2)
+        records = []
+        for i,phrase1 in enumerate(phrases1):
+            for j,phrase2 in enumerate(phrases2):
                 if (phrase1[0] != phrase2[0]):
                     sys.exit("Different pivot phrases\n")
                 src, tgt = phrase1[1], phrase2[1]
 
-                features = self._get_features(src, tgt, phrase1[2], phrase2[2])
-                word_alignments = self._get_word_alignments(src, tgt, phrase1[3], phrase2[3])
-                word_counts = self._get_cooccurrence_counts(src, tgt, phrase1[4], phrase2[4])
-                outline = _write_phrasetable_file([src,tgt,features,word_alignments,word_counts])
-                output_object.write(outline)
-                output_tgt.write(b'%s ||| %s ||| %i\n' %(tgt,src,word_counts[2]))
-                #output_src.write(b'%s ||| %s ||| %i\n' %(src,tgt,word_counts[2]))
+                if (group):
+                    features = group[0][i][j]
+                    word_counts = [group[2][j], group[1][i], group[3][i][j]]
+                else:
+                    features = self._get_features(src, tgt, phrase1[2], phrase2[2])
+                    word_counts = self._get_cooccurrence_counts(src, tgt, phrase1[4], phrase2[4])
+                if (self._below_threshold(features, word_counts)):
+                    self.stats['filtered_pairs'] += 1
+                    continue
+                word_alignments = self._compose_alignments(src, tgt, phrase1, phrase2, indexes, j)
+                if (self.fused):
+                    self._aggregate_line([src,tgt,features,word_alignments,word_counts])
+                else:
+                    records.append(_pack_line([src,tgt,features,word_alignments,word_counts]))
+                    if (len(records) >= write_batch_size):
+                        _write_records(output_object,records)
+                        records = []
 
                 self._update_moses(src,tgt,word_alignments,word_counts)
+        if (records):
+            _write_records(output_object,records)
         # reset the memory
         self.phrase_match = None
         self.phrase_match = defaultdict(lambda: []*3)
 
 
+    def _prune_fanout(self, phrases1, phrases2):
+        ''' Keep the max_pivot_fanout best source phrases by p(pvt|src)
+            and target phrases by p(tgt|pvt) of a pivot group, in their original order
+        '''
+        if (not phrases1 or not phrases2):
+            return phrases1, phrases2
+        self.stats['groups'] += 1
+        pairs = len(phrases1)*len(phrases2)
+        if (self.max_pivot_fanout):
+            phrases1 = _top_phrases(phrases1, 0, self.max_pivot_fanout)
+            phrases2 = _top_phrases(phrases2, 2, self.max_pivot_fanout)
+            kept_pairs = len(phrases1)*len(phrases2)
+            if (kept_pairs < pairs):
+                self.stats['pruned_groups'] += 1
+                self.stats['pruned_src'] += len(self.phrase_match[1]) - len(phrases1)
+                self.stats['pruned_tgt'] += len(self.phrase_match[2]) - len(phrases2)
+                self.stats['pruned_pairs'] += pairs - kept_pairs
+                pairs = kept_pairs
+        self.stats['pairs'] += pairs
+        return phrases1, phrases2
+
+    def _below_threshold(self, features, word_counts):
+        ''' Whether a triangulated phrase pair is dropped by min_prob or min_count
+        '''
+        if (self.min_prob and max(features[0], features[2]) < self.min_prob):
+            return True
+        if (self.min_count and word_counts[2] < self.min_count):
+            return True
+        return False
+
+    def _group_below_threshold(self, phrases1, phrases2):
+        ''' Whether no phrase pair of a pivot group can pass min_prob or min_count
+            The features are products and the count estimates are monotonic,
+            so the maxima of both sides give upper bounds
+        '''
+        if (not phrases1 or not phrases2):
+            return False
+        if (self.min_prob):
+            max1 = [max(phrase[2][i] for phrase in phrases1) for i in (0,2)]
+            max2 = [max(phrase[2][i] for phrase in phrases2) for i in (0,2)]
+            # features[0] = p1[2]*p2[0] and features[2] = p1[0]*p2[2]
+            if (max(max1[1]*max2[0], max1[0]*max2[1]) < self.min_prob):
+                return True
+        if (self.min_count):
+            try:
+                bound = self.estimate_counts(max(phrase[4][2] for phrase in phrases1), max(phrase[4][2] for phrase in phrases2))
+            except (IndexError, ValueError):
+                # missing co-occurrence counts, leave it to the pairs
+                return False
+            if (bound < self.min_count):
+                return True
+        return False
+
+    def _aggregate_line(self, line):
+        ''' Combine a triangulated phrase pair with the identical pairs kept in memory
+            The same way as Merge_TM does, except for the phrase counts (line[4][0] and line[4][1])
+            which are replaced while merging
+            When the memory budget is exceeded, the pairs are written as a sorted run
+        '''
+        key = (line[0],line[1])
+        prev_line = self.aggregated.get(key)
+        if (prev_line is None):
+            self.aggregated[key] = line
+            # rough size of the strings, lists and numbers of a line in memory
+            self.aggregated_size += len(line[0]) + len(line[1]) + 600
+            if (self.aggregated_size >= sort_buffer_size):
+                self._spill_aggregated()
+            return
+        # features
+        if (self.action == 'features_based' and self.weight == 'maximization'):
+            for i in range(4):
+                prev_line[2][i] = max(prev_line[2][i], line[2][i])
+        else:
+            for i in range(4):
+                prev_line[2][i] += line[2][i]
+                prev_line[2][i] = min(prev_line[2][i], 1.0)
+        # alignment
+        for pair in line[3]:
+            if (pair not in prev_line[3]):
+                prev_line[3].append(pair)
+        # count
+        prev_line[4][2] += line[4][2]
+
+    def _sorted_aggregated(self):
+        ''' Sort the records of the combined phrase pairs and empty the memory
+        '''
+        lines = []
+        for line in self.aggregated.itervalues():
+            lines.append(_pack_line(line))
+        lines.sort()
+        self.aggregated, self.aggregated_size = {}, 0
+        return lines
+
+    def _spill_aggregated(self):
+        ''' Write the combined phrase pairs into a sorted run in the temporary directory
+        '''
+        if (not self.aggregated):
+            return
+        self.aggregated_runs.append(_write_run(self._sorted_aggregated(),self.tempdir,sort_compress,records=True))
+
+    def _write_aggregated(self, output_object):
+        ''' Write the sorted phrase table of combined phrase pairs,
+            identical pairs from different runs are combined later by Merge_TM
+        '''
+        if (not self.aggregated_runs):
+            lines = self._sorted_aggregated()
+        else:
+            self._spill_aggregated()
+            sys.stderr.write("Merge {0} runs of combined phrase pairs\n".format(len(self.aggregated_runs)))
+            lines = _merge_runs(self.aggregated_runs,self.tempdir,sort_compress,records=True)
+            self.aggregated_runs = []
+        for line in lines:
+            _write_record(output_object,line)
+
     def _update_moses(self, src, tgt, word_alignments, word_counts):
         ''' Update following variables: word counts e2f, f2e, phrase count e, f
         '''
-        srcphrase = src.split(b' ')
-        tgtphrase = tgt.split(b' ')
-        tgt_lst = []
-        src_lst = []
+        moses = self.moses_interface
+        # as the counts are written to the phrase table
+        moses.phrase_count_e.add(src,long(word_counts[2]))
+        moses.phrase_count_f.add(tgt,long(word_counts[2]))
+        srcphrase = moses.vocab_e.get_ids(src)
+        tgtphrase = moses.vocab_f.get_ids(tgt)
+        src_aligned = [False]*len(srcphrase)
+        tgt_aligned = [False]*len(tgtphrase)
         for align in word_alignments:
             src_id,tgt_id=align
-            self.moses_interface.word_pairs_e2f[srcphrase[src_id]][tgtphrase[tgt_id]] += word_counts[2]
-            self.moses_interface.word_count_e[srcphrase[src_id]] += word_counts[2]
-            #self.moses_interface.word_pairs_f2e[tgtphrase[tgt_id]][srcphrase[src_id]] += word_counts[2]
-            self.moses_interface.word_count_f[tgtphrase[tgt_id]] += word_counts[2]
-            tgt_lst.append(tgt_id)
-            src_lst.append(src_id)
+            moses._add_pair(srcphrase[src_id],tgtphrase[tgt_id],word_counts[2])
+            src_aligned[src_id] = True
+            tgt_aligned[tgt_id] = True
 
         # unaligned words
         for idx in range(len(tgtphrase)):
-            if idx not in tgt_lst:
-                self.moses_interface.word_pairs_e2f[b'NULL'][tgtphrase[idx]] += word_counts[2]
-                self.moses_interface.word_count_e[b'NULL']+=word_counts[2]
-                self.moses_interface.word_count_f[tgtphrase[idx]] += word_counts[2]
+            if not tgt_aligned[idx]:
+                moses._add_pair(NULL_ID,tgtphrase[idx],word_counts[2])
         # unaligned words
         for idx in range(len(srcphrase)):
-            if idx not in src_lst:
-                self.moses_interface.word_pairs_e2f[srcphrase[idx]][b'NULL'] += word_counts[2]
-                self.moses_interface.word_count_f[b'NULL']+=word_counts[2]
-                self.moses_interface.word_count_e[srcphrase[idx]] += word_counts[2]
+            if not src_aligned[idx]:
+                moses._add_pair(srcphrase[idx],NULL_ID,word_counts[2])
 
 
     def _get_features_Cohn(self,src,target,feature1,feature2):
@@ -824,16 +1810,66 @@ class Triangulate_TMs():
 
         return phrase_features
 
+    def _get_group_features(self,phrases1,phrases2):
+        ''' Compute the features and the co-occurrence counts of all pairs of a pivot group at once
+            Return (features[i][j], count1[i], count2[j], coocc[i][j])
+            or None when NumPy is missing, the group is small or the phrases are incomplete
+        '''
+        if (numpy is None or len(phrases1)*len(phrases2) < batch_min_pairs):
+            return None
+        if (self._get_features != self._get_features_Cohn or self.number_of_features != 4):
+            return None
+        estimate = OUTER_ESTIMATES.get(self.estimate_counts)
+        if (estimate is None):
+            return None
+        # a row with missing features or counts is left to the per-pair path, see _get_cooccurrence_counts
+        for phrases in (phrases1,phrases2):
+            for phrase in phrases:
+                if (len(phrase[2]) < 4 or len(phrase[4]) < 3):
+                    return None
+        features1 = numpy.array([phrase[2][:4] for phrase in phrases1], dtype=numpy.float64)
+        features2 = numpy.array([phrase[2][:4] for phrase in phrases2], dtype=numpy.float64)
+        counts1 = numpy.array([phrase[4][:3] for phrase in phrases1], dtype=numpy.int64)
+        counts2 = numpy.array([phrase[4][:3] for phrase in phrases2], dtype=numpy.int64)
+
+        # the same products as _get_features_Cohn
+        features = numpy.empty((len(phrases1),len(phrases2),4))
+        features[:,:,0] = numpy.outer(features1[:,2],features2[:,0])
+        features[:,:,1] = numpy.outer(features1[:,3],features2[:,1])
+        features[:,:,2] = numpy.outer(features1[:,0],features2[:,2])
+        features[:,:,3] = numpy.outer(features1[:,1],features2[:,3])
+        coocc = estimate(counts1[:,2],counts2[:,2])
+
+        return (features.tolist(), counts1[:,0].tolist(), counts2[:,0].tolist(), coocc.tolist())
+
+    def _compose_alignments(self,src,target,phrase1,phrase2,indexes,j):
+        ''' The word alignments of a pair of a pivot group, memoized by the raw alignment fields
+            indexes[j] is the index of phrase2 (the j-th of the group), built on first use
+        '''
+        key = (phrase1.raw_field(3), phrase2.raw_field(3))
+        word_alignments = self.alignment_memo.get(key)
+        if (word_alignments is None):
+            if (indexes[j] is None):
+                indexes[j] = _alignment_index(phrase2[3])
+            word_alignments = self._get_word_alignments(src, target, phrase1[3], indexes[j])
+            if (len(self.alignment_memo) >= alignment_memo_size):
+                self.alignment_memo.clear()
+            self.alignment_memo[key] = word_alignments
+        # the combined phrase pairs extend their alignments
+        return list(word_alignments)
+
     def _get_word_alignments(self,src,target,phrase_ps,phrase_pt):
         """ Align source words and target words within the two phrases
             based on the pivot-source and pivot-target alignments
+            phrase_pt may be given as its index by pivot position (see _alignment_index)
             The mismatched alignments are handled in _update_moses function
         """
+        if (not isinstance(phrase_pt, dict)):
+            phrase_pt = _alignment_index(phrase_pt)
         phrase_st = []
         for pvt_src in phrase_ps:
-            for pvt_tgt in phrase_pt:
-                if (pvt_src[0] == pvt_tgt[0]):
-                    phrase_st.append((pvt_src[1],pvt_tgt[1]))
+            for tgt in phrase_pt.get(pvt_src[0], ()):
+                phrase_st.append((pvt_src[1],tgt))
         return list(set(phrase_st))
 
 
@@ -854,6 +1890,167 @@ class Triangulate_TMs():
             sys.stderr.write("Missing co-occurrence counts, set default value to 0\n")
         return word_count
 
+class IncrementalState():
+    """ The triangulation of the previous run, kept in a directory (see --incremental)
+        'triangulated' holds its records in pivot order, 'state' the options, the word and
+        phrase counts and, for each pivot phrase, the digest of its rows in both phrase tables
+        and the byte range of its records
+    """
+    def __init__(self, directory, settings):
+        self.directory = directory
+        self.settings = settings
+        self.groups = {}
+        self.counts = None
+        self.records = None
+        self.new_groups = {}
+        self.stats = defaultdict(long)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        statefile = os.path.join(directory, 'state')
+        if not os.path.exists(statefile):
+            return
+        with open(statefile, 'rb') as infile:
+            state = pickle.load(infile)
+        if (state['settings'] != settings):
+            sys.stderr.write("The options changed since the previous triangulation, triangulate all pivot phrases\n")
+            return
+        self.groups, self.counts = state['groups'], state['counts']
+        recordfile = os.path.join(directory, 'triangulated')
+        if (os.path.getsize(recordfile)):
+            with open(recordfile, 'rb') as infile:
+                self.records = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def digest(self, phrases1, phrases2):
+        ''' The digest of the rows of a pivot phrase in both phrase tables
+        '''
+        digest = hashlib.md5()
+        for phrases in (phrases1, phrases2):
+            digest.update(RECORD_LENGTH.pack(len(phrases)))
+            for phrase in phrases:
+                digest.update(RECORD_LENGTH.pack(len(phrase.raw)))
+                digest.update(phrase.raw)
+        return digest.digest()
+
+    def old_records(self, group):
+        ''' yield the previous records of a pivot group
+        '''
+        pos, end = group[1], group[2]
+        while (pos < end):
+            length = RECORD_LENGTH.unpack_from(self.records, pos)[0]
+            pos += RECORD_LENGTH.size
+            yield self.records[pos:pos+length]
+            pos += length
+
+    def copy_group(self, group, output_object):
+        if (group[1] < group[2]):
+            output_object.write(self.records[group[1]:group[2]])
+
+    def save(self, output_file, moses):
+        ''' Keep the triangulated records and the counts for the next run
+        '''
+        if (self.records is not None):
+            self.records.close()
+            self.records = None
+        recordfile = os.path.join(self.directory, 'triangulated')
+        statefile = os.path.join(self.directory, 'state')
+        shutil.copyfile(output_file, recordfile + '.new')
+        with open(statefile + '.new', 'wb') as outfile:
+            pickle.dump({'settings': self.settings, 'groups': self.new_groups, 'counts': moses._save_counts()}, outfile, 2)
+        os.rename(recordfile + '.new', recordfile)
+        os.rename(statefile + '.new', statefile)
+
+def triangulate_pivots(triangulators):
+    ''' Triangulate the phrase tables of several pivot languages concurrently, one process each,
+        and add up their word and phrase counts in the moses interface of the first triangulator
+        Return the sorted outputs merged into one stream of records, in which the identical
+        phrase pairs of all pivot languages follow each other (see Merge_TM._combine_lines)
+    '''
+    processes = []
+    for triangulator in triangulators:
+        result = NamedTemporaryFile(delete=False,dir=triangulator.tempdir,prefix='pivot')
+        result.close()
+        p = Process(target=_glob_triangulate_pivot, args=[triangulator,result.name])
+        p.start()
+        sys.stderr.write(" --- process started at: {0} --- ".format(datetime.now()))
+        processes.append((p,result.name))
+
+    moses = triangulators[0].moses_interface
+    outfiles = []
+    for p,result_file in processes:
+        p.join()
+        sys.stderr.write("--- process joined at: {0} --- ".format(datetime.now()))
+        if (p.exitcode):
+            raise RuntimeError("The triangulation of a pivot language failed with exit code {0}".format(p.exitcode))
+        with open(result_file,'rb') as result:
+            outfile, counts = pickle.load(result)
+        os.remove(result_file)
+        moses._add_counts(*counts)
+        outfiles.append(outfile)
+
+    sys.stderr.write("\nMerge the phrase tables of {0} pivot languages\n".format(len(outfiles)))
+    # _read_run removes each file once it is read
+    return heapq.merge(*[_read_run(name,None,records=True) for name in outfiles])
+
+class TableCache():
+    """ The prepared versions of input phrase tables (see --cache): inverted and pivot-sorted,
+        encoded into binary records or decompressed, kept in a directory by the md5 checksum of the input
+        The checksums are kept in 'index' by file name, size and modification time,
+        so that an unchanged input is not read again
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.indexfile = os.path.join(directory, 'index')
+        self.index = self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.indexfile):
+            return {}
+        with open(self.indexfile, 'rb') as infile:
+            return pickle.load(infile)
+
+    def checksum(self, filename):
+        ''' The checksum of an input file, computed again when its size or modification time changed
+        '''
+        filename = os.path.realpath(filename)
+        stat = os.stat(filename)
+        entry = self.index.get(filename)
+        if (entry and entry[:2] == (stat.st_size, stat.st_mtime)):
+            return entry[2]
+        entry = (stat.st_size, stat.st_mtime, _file_checksum(filename))
+        # another process may have added files to the index
+        self.index = self._load_index()
+        self.index[filename] = entry
+        partial = self.partial()
+        with open(partial, 'wb') as outfile:
+            pickle.dump(self.index, outfile, 2)
+        os.rename(partial, self.indexfile)
+        return entry[2]
+
+    def path(self, filename, kind):
+        return os.path.join(self.directory, "{0}.{1}".format(self.checksum(filename), kind))
+
+    def get(self, filename, kind):
+        ''' The name of the prepared table of an input file, or None
+        '''
+        cached = self.path(filename, kind)
+        if os.path.exists(cached):
+            return cached
+        return None
+
+    def partial(self):
+        ''' A new file in the cache directory, which put renames once it is complete
+        '''
+        outfile = NamedTemporaryFile(delete=False,dir=self.directory,prefix='partial')
+        outfile.close()
+        return outfile.name
+
+    def put(self, partial, filename, kind):
+        cached = self.path(filename, kind)
+        os.rename(partial, cached)
+        return cached
+
 # --------------------------------------------------------------------------
 # Section 6: Global functions
 # --------------------------------------------------------------------------
@@ -869,8 +2066,10 @@ def handle_file(filename,action,fileobj=None,mode='r'):
             mode = 'wb'
 
         if mode == 'rb' and not filename == '-' and not os.path.exists(filename):
-            if os.path.exists(filename+'.gz'):
-                filename = filename+'.gz'
+            for extension in ['.gz','.zst','.lz4']:
+                if os.path.exists(filename+extension):
+                    filename = filename+extension
+                    break
             else:
                 sys.stderr.write('Error: unable to open file. ' + filename + ' - aborting.\n')
 
@@ -880,58 +2079,521 @@ def handle_file(filename,action,fileobj=None,mode='r'):
 
                 exit(1)
 
-        if filename.endswith('.gz'):
-            fileobj = gzip.open(filename,mode)
+        if filename.endswith('.gz') and mode == 'wb':
+            fileobj = _GzipWriter(filename,io_threads)
 
         elif filename == '-' and mode == 'wb':
             fileobj = sys.stdout
 
+        elif mode == 'rb':
+            fileobj = _open_compressed(filename)
+
         else:
                 fileobj = open(filename,mode)
 
+        if mode == 'wb':
+            fileobj = _AsyncWriter(fileobj)
+
         return fileobj
 
-    elif action == 'close' and filename != '-':
-        fileobj.close()
+    elif action == 'close':
+        if isinstance(fileobj,_AsyncWriter):
+            # the standard output is flushed, but stays open
+            fileobj.close(filename != '-')
+        elif filename != '-':
+            fileobj.close()
 
 
-def sort_file(filename,tempdir=None):
+def sort_file(filename,tempdir=None,records=False):
     """ Sort a file and return temporary file
     """
+    fileobj = handle_file(filename,'open',mode='r')
+    if records:
+        outfile = sort_stream(_RecordFile(fileobj),tempdir=tempdir,records=True)
+    else:
+        outfile = sort_stream(fileobj,tempdir=tempdir)
+    handle_file(filename,'close',fileobj,mode='r')
+    return outfile
 
-    cmd = ['sort', filename]
-    env = {}
-    env['LC_ALL'] = 'C'
-    if tempdir:
-        cmd.extend(['-T',tempdir])
-
-    outfile = NamedTemporaryFile(delete=False,dir=tempdir)
-    sys.stderr.write('LC_ALL=C ' + ' '.join(cmd) + ' > ' + outfile.name + '\n')
-    p = Popen(cmd,env=env,stdout=outfile.file)
-    p.wait()
+def sort_file_fix(filename,newname,tempdir=None,records=False):
+    """ Sort a file and return temporary file with fix name
+    """
+    fileobj = handle_file(filename,'open',mode='r')
+    if records:
+        outfile = sort_stream(_RecordFile(fileobj),"{0}/{1}".format(tempdir,newname),tempdir=tempdir,records=True)
+    else:
+        outfile = sort_stream(fileobj,"{0}/{1}".format(tempdir,newname),tempdir=tempdir)
+    handle_file(filename,'close',fileobj,mode='r')
+    return outfile
 
+def sort_file_lines(filename,tempdir=None,records=False):
+    """ Sort a file and yield its lines (or records) without writing a sorted file,
+        the last merge pass of the external sort streams into the caller
+        The file is removed once it is read
+    """
+    fileobj = handle_file(filename,'open',mode='r')
+    if records:
+        lines = sort_lines(_RecordFile(fileobj),tempdir=tempdir,records=True)
+    else:
+        lines = sort_lines(fileobj,tempdir=tempdir)
+    # the whole file is read before the first line is sorted
+    first = next(lines,None)
+    handle_file(filename,'close',fileobj,mode='r')
+    sys.stderr.write("Remove the unsorted file {0}\n".format(filename))
+    os.remove(filename)
+    if first is None:
+        return
+    yield first
+    for line in lines:
+        yield line
+
+def sort_stream(lines,newname=None,tempdir=None,records=False):
+    """ Sort lines (or binary records) into a temporary file (or the file newname) and return it
+        A file of records is returned as a _RecordFile
+    """
+    if newname:
+        outfile = open(newname,mode='w+b')
+    else:
+        outfile = NamedTemporaryFile(delete=False,dir=tempdir)
+    sys.stderr.write('Sort > ' + outfile.name + '\n')
+    if records:
+        for line in sort_lines(lines,tempdir=tempdir,records=True):
+            _write_record(outfile,line)
+    else:
+        outfile.writelines(line + b'\n' for line in sort_lines(lines,tempdir=tempdir))
+    outfile.flush()
     outfile.seek(0)
 
+    if records:
+        return _RecordFile(outfile)
     return outfile
 
-def sort_file_fix(filename,newname,tempdir=None):
-    """ Sort a file and return temporary file with fix name
+def sort_lines(lines,tempdir=None,buffer_size=None,compress=None,records=False):
+    """ External merge sort, yields the lines in byte order like LC_ALL=C sort
+        The lines are yielded without line breaks
+        At most buffer_size bytes of lines are kept in memory, each sorted run is
+        written to tempdir (compressed with gzip or lz4) and the runs are merged with a heap
+    """
+    if buffer_size is None:
+        buffer_size = sort_buffer_size
+    if compress is None:
+        compress = sort_compress
+
+    runs = []
+    buf,buf_size = [],0
+    for line in lines:
+        # sort compares lines without the line break
+        if not records and line.endswith(b'\n'):
+            line = line[:-1]
+        buf.append(line)
+        # the length of the line plus the overhead of a string in a list
+        buf_size += len(line) + 48
+        if (buf_size >= buffer_size):
+            buf.sort()
+            runs.append(_write_run(buf,tempdir,compress,records))
+            buf,buf_size = [],0
+    buf.sort()
+
+    # everything fits into memory
+    if (not runs):
+        for line in buf:
+            yield line
+        return
+    if (buf):
+        runs.append(_write_run(buf,tempdir,compress,records))
+    buf = None
+
+    for line in _merge_runs(runs,tempdir,compress,records):
+        yield line
+
+def _merge_runs(runs,tempdir=None,compress=None,records=False):
+    """ Merge sorted run files with a heap and yield their lines without line breaks
+        The run files are removed
+    """
+    # limit the number of files opened at the same time
+    while (len(runs) > sort_max_runs):
+        merged = _write_run(heapq.merge(*[_read_run(run,compress,records) for run in runs[:sort_max_runs]]),tempdir,compress,records)
+        runs = runs[sort_max_runs:] + [merged]
+
+    try:
+        for line in heapq.merge(*[_read_run(run,compress,records) for run in runs]):
+            yield line
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+
+def _open_run(filename,mode,compress):
+    """ Open a sorted run of the external sort
     """
+    if (compress == 'gzip'):
+        return gzip.open(filename,mode,1)
+    elif (compress == 'lz4'):
+        if lz4frame is None:
+            raise ImportError("The lz4 module is required to compress sorted runs with lz4")
+        return lz4frame.open(filename,mode)
+    return open(filename,mode)
+
+def _write_run(lines,tempdir,compress,records=False):
+    """ Write sorted lines into a temporary run file and return its name
+    """
+    outfile = NamedTemporaryFile(delete=False,dir=tempdir,prefix='sortrun')
+    outfile.close()
+    run = _open_run(outfile.name,'wb',compress)
+    if records:
+        for line in lines:
+            _write_record(run,line)
+    else:
+        run.writelines(line + b'\n' for line in lines)
+    run.close()
+    return outfile.name
 
-    cmd = ['sort', filename]
-    env = {}
-    env['LC_ALL'] = 'C'
-    if tempdir:
-        cmd.extend(['-T',tempdir])
+def _read_run(filename,compress,records=False):
+    """ Yield the lines of a sorted run without line breaks, then remove the run
+    """
+    run = _open_run(filename,'rb',compress)
+    if records:
+        for line in _RecordFile(run):
+            yield line
+    else:
+        for line in run:
+            yield line[:-1]
+    run.close()
+    os.remove(filename)
 
-    outfile=open("{0}/{1}".format(tempdir,newname),mode='w')
-    sys.stderr.write('LC_ALL=C ' + ' '.join(cmd) + ' > ' + outfile.name + '\n')
-    p = Popen(cmd,env=env,stdout=outfile)
-    p.wait()
+def _file_checksum(filename):
+    """ The md5 checksum of the content of a file
+    """
+    digest = hashlib.md5()
+    with open(filename,'rb') as infile:
+        block = infile.read(io_block_size)
+        while block:
+            digest.update(block)
+            block = infile.read(io_block_size)
+    return digest.hexdigest()
+
+def _parse_size(size):
+    """ Convert a size such as 512K, 256M or 4G into bytes
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = size.strip().upper().rstrip('B')
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: {0}".format(size))
+
+class PivotGroupReader():
+    """ Read a pivot-sorted phrase table (text lines or records) group by group,
+        a group being the lines of one pivot phrase
+        key is the sort key of the current group (see _pivot_key), None at the end of the table
+        read() returns the lines of the current group as PhraseRecords, skip() passes over them
+        comparing raw bytes only, both move to the next group
+    """
+    def __init__(self,fileobj):
+        self.fileobj = fileobj
+        self._start(fileobj.readline())
+
+    def __iter__(self):
+        ''' yield (key, parsed lines) of all groups '''
+        while (self.key is not None):
+            key = self.key
+            yield key,self.read()
+
+    def _start(self,line):
+        # the line starts a new group
+        self.line = line
+        if (line):
+            self.key = _raw_pivot_key(line)
+            # all lines of the group start with the same bytes, up to the first separator
+            self.prefix = line[:line.index(b'|||')+3]
+        else:
+            self.key = None
+
+    def _in_group(self,line):
+        return line.startswith(self.prefix) or _raw_pivot_key(line) == self.key
+
+    def skip(self):
+        if hasattr(self.fileobj,'skip_prefix'):
+            # pass over the lines in the memory map, without copying them
+            self.fileobj.skip_prefix(self.prefix)
+        readline = self.fileobj.readline
+        line = readline()
+        while (line and self._in_group(line)):
+            line = readline()
+        self._start(line)
+
+    def read(self):
+        readline = self.fileobj.readline
+        lines = [PhraseRecord(self.line)]
+        line = readline()
+        while (line and self._in_group(line)):
+            lines.append(PhraseRecord(line))
+            line = readline()
+        self._start(line)
+        return lines
+
+class _MappedFile():
+    """ Read the lines (or the length-prefixed records) of an uncompressed file through
+        a read-only memory map, optionally only the byte range [start, end)
+        A line is copied out of the map when it is read, skip_prefix passes over lines in place
+    """
+    def __init__(self,filename,start=0,end=None,records=False):
+        self.name = filename
+        self.records = records
+        size = os.path.getsize(filename)
+        if (end is None or end > size):
+            end = size
+        self.fileobj = open(filename,'rb')
+        # an empty file cannot be mapped
+        self.map = None
+        if (size):
+            self.map = mmap.mmap(self.fileobj.fileno(),0,access=mmap.ACCESS_READ)
+        self.pos = start
+        self.end = end
+
+    def _bounds(self,pos):
+        ''' The start and the end of the line (or record) at pos
+        '''
+        if (self.records):
+            start = pos + RECORD_LENGTH.size
+            return start,start + RECORD_LENGTH.unpack_from(self.map,pos)[0]
+        end = self.map.find(b'\n',pos,self.end)
+        if (end < 0):
+            return pos,self.end
+        return pos,end+1
+
+    def readline(self):
+        if (self.pos >= self.end):
+            return b''
+        start,end = self._bounds(self.pos)
+        self.pos = end
+        return self.map[start:end]
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def skip_prefix(self,prefix):
+        ''' Move past the following lines which start with prefix
+        '''
+        mapped,size = self.map,len(prefix)
+        pos = self.pos
+        while (pos < self.end):
+            start,end = self._bounds(pos)
+            if (mapped.find(prefix,start,start+size) != start):
+                break
+            pos = end
+        self.pos = pos
+
+    def close(self):
+        if (self.map is not None):
+            self.map.close()
+        self.fileobj.close()
+
+def _open_mapped(fileobj):
+    """ Map an uncompressed phrase table (or file of records) from its current position,
+        other files (gzip, pipes) are returned as they are
+    """
+    if isinstance(fileobj,IndexedTable):
+        return _MappedFile(fileobj.name,fileobj.start,fileobj.end,records=True)
+    elif isinstance(fileobj,_RecordFile):
+        if (fileobj.end is None and os.path.isfile(fileobj.name)):
+            return _MappedFile(fileobj.name,fileobj.pos,records=True)
+    elif isinstance(fileobj,file) and os.path.isfile(fileobj.name):
+        return _MappedFile(fileobj.name,fileobj.tell())
+    return fileobj
+
+def _table_size(fileobj):
+    """ The number of bytes of a phrase table from the current position of a file object
+    """
+    if isinstance(fileobj,IndexedTable):
+        return fileobj.size
+    end = getattr(fileobj,'end',None)
+    if (end is None):
+        end = os.path.getsize(fileobj.name)
+    return end - getattr(fileobj,'pos',0)
+
+def _open_shard(filename,byte_range,records):
+    """ Open a byte range of a text file or of a file of records,
+        the whole indexed table without a byte range
+    """
+    if (byte_range is None):
+        return IndexedTable(filename)
+    return _MappedFile(filename,byte_range[0],byte_range[1],records)
+
+def _get_shards(filename1,filename2,jobs,records1=False,records2=False):
+    """ Split two pivot-sorted files into at most `jobs` pairs of byte ranges
+        The two ranges of a pair cover the same pivot phrases
+        The records of an indexed table (see IndexedTable) are cut with its index
+    """
+    table1 = IndexedTable(filename1) if _is_indexed(filename1) else None
+    table2 = IndexedTable(filename2) if _is_indexed(filename2) else None
+    start1,size1 = (table1.start,table1.end) if table1 else (0,os.path.getsize(filename1))
+    start2,size2 = (table2.start,table2.end) if table2 else (0,os.path.getsize(filename2))
+
+    # the pivot phrases of the first complete lines after the cuts
+    if table1:
+        keys = table1.cut_keys(jobs)
+        offsets1 = table1.seek_pivots(keys)
+    else:
+        keys = _cut_keys(filename1,size1,jobs,records1)
+        offsets1 = _seek_pivots(filename1,size1,keys,records1)
+    if table2:
+        offsets2 = table2.seek_pivots(keys)
+    else:
+        offsets2 = _seek_pivots(filename2,size2,keys,records2)
+    for table in (table1,table2):
+        if table:
+            table.close()
+
+    bounds1,bounds2 = [start1],[start2]
+    for offset1,offset2 in zip(offsets1,offsets2):
+        if (offset1 <= bounds1[-1]):
+            continue
+        bounds1.append(offset1)
+        bounds2.append(offset2)
+    bounds1.append(size1)
+    bounds2.append(size2)
+
+    return [((bounds1[i],bounds1[i+1]),(bounds2[i],bounds2[i+1])) for i in range(len(bounds1)-1)]
+
+def _cut_table(filename,jobs,records=False):
+    """ Split a pivot-sorted file into at most `jobs` byte ranges, which start at different pivot phrases
+    """
+    return [range1 for range1,range2 in _get_shards(filename,filename,jobs,records,records)]
 
-    outfile.seek(0)
+def _cut_lines(filename,jobs):
+    """ Split a text file into at most `jobs` byte ranges of whole lines
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    fileobj = open(filename,'rb')
+    for i in range(1,jobs):
+        cut = size*i//jobs
+        if (cut == 0):
+            continue
+        # the first line which starts at or after the cut
+        fileobj.seek(cut-1)
+        fileobj.readline()
+        if (bounds[-1] < fileobj.tell() < size):
+            bounds.append(fileobj.tell())
+    fileobj.close()
+    bounds.append(size)
+    return [(bounds[i],bounds[i+1]) for i in range(len(bounds)-1)]
+
+def _cut_keys(filename,size,jobs,records):
+    """ The pivot keys of the first lines after cutting a file into `jobs` equal parts
+    """
+    cuts = [size*i//jobs for i in range(1,jobs)]
+    keys = []
+    if records:
+        # records cannot be found from an arbitrary offset, scan them
+        for offset,line in _scan_records(filename):
+            while (cuts and offset >= cuts[0]):
+                cuts.pop(0)
+                keys.append(_raw_pivot_key(line))
+            if (not cuts):
+                break
+    else:
+        fileobj = open(filename,'rb')
+        for cut in cuts:
+            fileobj.seek(cut)
+            fileobj.readline()
+            line = fileobj.readline()
+            if (not line):
+                break
+            keys.append(_raw_pivot_key(line))
+        fileobj.close()
+    return sorted(set(keys))
 
-    return outfile
+def _seek_pivots(filename,size,keys,records):
+    """ The offsets of the first lines whose pivot keys are not smaller than the keys (sorted)
+    """
+    offsets = []
+    if records:
+        scan = _scan_records(filename)
+        offset,line = next(scan,(size,None))
+        for key in keys:
+            while (line is not None and _raw_pivot_key(line) < key):
+                offset,line = next(scan,(size,None))
+            offsets.append(offset)
+    else:
+        fileobj = open(filename,'rb')
+        for key in keys:
+            offsets.append(_seek_pivot(fileobj,size,key))
+        fileobj.close()
+    return offsets
+
+def _scan_records(filename):
+    """ Yield the offsets and the records of a file of records
+    """
+    records = _RecordFile(open(filename,'rb'))
+    offset = 0
+    line = records.readline()
+    while line:
+        yield offset,line
+        offset = records.pos
+        line = records.readline()
+    records.close()
+
+def _seek_pivot(fileobj,size,key):
+    """ Binary search for the offset of the first line whose pivot key is not smaller than key
+    """
+    def first_line(offset):
+        # the first line which starts at or after offset
+        if (offset == 0):
+            fileobj.seek(0)
+        else:
+            fileobj.seek(offset-1)
+            fileobj.readline()
+        return fileobj.tell(),fileobj.readline()
+
+    low,high = 0,size
+    while (low < high):
+        mid = (low+high)//2
+        start,line = first_line(mid)
+        if (not line or _raw_pivot_key(line) >= key):
+            high = mid
+        else:
+            low = mid+1
+    return first_line(low)[0]
+
+def _pivot_key(phrase):
+    ''' The phrase tables are sorted by whole lines (LC_ALL=C sort),
+        hence phrases are ordered together with the following field separator,
+        e.g. 'a b |||' < 'a |||' < 'ab |||'
+    '''
+    return phrase + b' |||'
+
+def _raw_pivot_key(line):
+    ''' The sort key of the first phrase of an unparsed line or record
+    '''
+    if (line[:1] == RECORD_MARK):
+        line = line[1:]
+    return _pivot_key(line.split(b'|||',1)[0].strip())
+
+def _top_phrases(phrases, feature, k):
+    ''' The k phrases with the highest value of a feature, in their original order
+    '''
+    if (len(phrases) <= k):
+        return phrases
+    kept = heapq.nlargest(k, range(len(phrases)), key=lambda i: phrases[i][2][feature])
+    return [phrases[i] for i in sorted(kept)]
+
+def _alignment_index(alignment):
+    ''' Map the pivot positions of an alignment to their aligned positions, in order
+    '''
+    index = {}
+    for pvt,pos in alignment:
+        if pvt in index:
+            index[pvt].append(pos)
+        else:
+            index[pvt] = [pos]
+    return index
 
 def get_minimum_counts(count1, count2):
     ''' Get the mimimum of two values
@@ -952,41 +2614,126 @@ def get_geometric_mean(count1, count2):
     '''
     return sqrt(count1*count2)
 
+# The estimates of get_*_counts for all pairs of a pivot group, see _get_group_features
+OUTER_ESTIMATES = {}
+if numpy is not None:
+    OUTER_ESTIMATES[get_minimum_counts] = numpy.minimum.outer
+    OUTER_ESTIMATES[get_maximum_counts] = numpy.maximum.outer
+    OUTER_ESTIMATES[get_arithmetic_mean] = lambda count1,count2: numpy.add.outer(count1,count2)/2
+
 def _load_line(line):
     if (not line):
         return None
+    if (line[:1] == RECORD_MARK):
+        return _unpack_line(line)
     ''' This function convert a string into an array of string and probability
         src ||| tgt ||| s|t s|t t|s t|s ||| align ||| countt counts countst ||| |||
     '''
-    line = line.rstrip().split(b'|||')
-    if line[-1].endswith(b' |||'):
-        line[-1] = line[-1][:-4]
-        line.append(b'')
+    line = _split_line(line)
 
     # remove blank spaces
     line[0] = line[0].strip()
     line[1] = line[1].strip()
 
     # probabilities
-    line[2]  = [float(i) for i in line[2].strip().split(b' ')]
+    line[2] = _parse_features(line[2])
 
     # alignment
+    line[3] = _parse_alignment(line[3])
+
+    # occurrence counts
+    line[4] = _parse_counts(line[4])
+
+    return line
+
+def _split_line(line):
+    ''' The undecoded fields of a phrase table line
+    '''
+    line = line.rstrip().split(b'|||')
+    if line[-1].endswith(b' |||'):
+        line[-1] = line[-1][:-4]
+        line.append(b'')
+    return line
+
+def _parse_features(field):
+    return [float(i) for i in field.strip().split(b' ')]
+
+def _parse_alignment(field):
     phrase_align = []
-    for pair in line[3].strip().split(b' '):
+    for pair in field.strip().split(b' '):
         try:
             s,t = pair.split(b'-')
             s,t = int(s),int(t)
             phrase_align.append([s,t])
         except:
             pass
-    line[3] = phrase_align
+    return phrase_align
 
-    # occurrence counts
-    line[4] = [long(float(i)) for i in line[4].strip().split(b' ')]
-    if len(line[4]) < 2:
+def _parse_counts(field):
+    counts = [long(float(i)) for i in field.strip().split(b' ')]
+    if len(counts) < 2:
         raise TypeError("The number of values in counting is not enough\n")
+    return counts
 
-    return line
+TEXT_PARSERS = [None, None, _parse_features, _parse_alignment, _parse_counts]
+
+class PhraseRecord(object):
+    """ A phrase table line (or record) whose fields are decoded on first access
+        It is indexed like the lists of _load_line: [src,tgt,features,alignment,counts]
+        key is the raw bytes 'src ||| tgt', which compare like the phrase pairs
+    """
+    __slots__ = ('raw','record','parts','fields')
+
+    def __init__(self,line):
+        self.raw = line
+        self.record = (line[:1] == RECORD_MARK)
+        self.parts = None
+        self.fields = [None]*5
+
+    def __len__(self):
+        return 5
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [self[i] for i in range(5)[index]]
+        field = self.fields[index]
+        if field is None:
+            field = self.fields[index] = self._decode(index)
+        return field
+
+    def __setitem__(self,index,value):
+        self.fields[index] = value
+
+    def _decode(self,index):
+        if self.parts is None:
+            if (self.record):
+                self.parts = _record_fields(self.raw)
+            else:
+                self.parts = _split_line(self.raw)
+        if (self.record):
+            if (index < 2):
+                return self.parts[index]
+            return _unpack_field(self.raw,self.parts,index)
+        if (index < 2):
+            return self.parts[index].strip()
+        return TEXT_PARSERS[index](self.parts[index])
+
+    def raw_field(self,index):
+        ''' The undecoded bytes of a field
+        '''
+        if self.parts is None:
+            self._decode(0)
+        if (self.record and index > 1):
+            end = self.parts[index+1][1] if index < 4 else len(self.raw)
+            return self.raw[self.parts[index][1]:end]
+        return self.parts[index]
+
+    @property
+    def key(self):
+        if (self.record):
+            raw = self.raw
+            return raw[1:raw.index(b' |||',raw.index(b' ||| ')+5)]
+        return self[0] + b' ||| ' + self[1]
 
 def _write_phrasetable_file(line):
     ''' Write lines of the phrase table
@@ -1009,6 +2756,523 @@ def _write_phrasetable_file(line):
     outline = b"%s ||| %s ||| %s ||| %s%s||| %s ||| |||\n" %(src,tgt,features,alignments,extra_space,word_counts)
     return outline
 
+def _inverted_lines(model):
+    ''' Yield the lines of a phrase table with source and target swapped
+        The fields are swapped as bytes: p(s|t) with p(t|s) and the points of the alignment,
+        the counts are kept
+    '''
+    alignments = {}
+    count=0
+    for line in model:
+        if not count%100000:
+            sys.stderr.write(str(count)+'...')
+        count+=1
+
+        parts = _split_line(line)
+        features = parts[2].strip().split(b' ')
+        features[0],features[2] = features[2],features[0]
+        # alignment fields repeat a lot
+        alignment = alignments.get(parts[3])
+        if alignment is None:
+            if (len(alignments) >= alignment_memo_size):
+                alignments.clear()
+            alignment = alignments[parts[3]] = b' '.join([b'-'.join(pair.split(b'-')[::-1]) for pair in parts[3].split()])
+        yield b'%s ||| %s ||| %s ||| %s |||%s' %(parts[1].strip(),parts[0].strip(),b' '.join(features),alignment,b'|||'.join(parts[4:]))
+
+# --------------------------------------------------------------------------
+# Section 7: Binary records of the intermediate files
+#   marker src ||| tgt ||| header features alignment counts
+#   The phrases are kept as text, so that records sort like the text lines
+#   In a file, each record is preceded by its length
+# --------------------------------------------------------------------------
+RECORD_MARK = b'\x00'
+RECORD_HEADER = struct.Struct(b'<BHB') # number of features, alignment points, counts
+RECORD_LENGTH = struct.Struct(b'<I')
+
+class _RecordFile():
+    """ Read a file of length-prefixed records like a file of lines,
+        optionally only the byte range [start, end)
+    """
+    def __init__(self,fileobj,start=0,end=None):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        if (start):
+            fileobj.seek(start)
+        self.pos = start
+        self.end = end
+
+    def readline(self):
+        if (self.end is not None and self.pos >= self.end):
+            return b''
+        length = self.fileobj.read(4)
+        if (len(length) < 4):
+            return b''
+        length = RECORD_LENGTH.unpack(length)[0]
+        self.pos += 4 + length
+        return self.fileobj.read(length)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def seek(self,offset):
+        self.fileobj.seek(offset)
+        self.pos = offset
+
+    def close(self):
+        self.fileobj.close()
+
+def _write_record(fileobj,record):
+    ''' Write a record with its length
+    '''
+    fileobj.write(RECORD_LENGTH.pack(len(record)))
+    fileobj.write(record)
+
+def _write_records(fileobj,records):
+    ''' Write a list of records with their lengths at once
+    '''
+    fileobj.write(b''.join([RECORD_LENGTH.pack(len(record)) + record for record in records]))
+
+def _pack_line(line):
+    ''' Convert a phrase table line [src,tgt,features,alignment,counts] into a record
+    '''
+    src,tgt,features,alignment,word_counts = line[:5]
+    points = []
+    for pair in alignment:
+        points.extend(pair)
+    return b''.join([RECORD_MARK, src, b' ||| ', tgt, b' |||',
+                     RECORD_HEADER.pack(len(features),len(alignment),len(word_counts)),
+                     struct.pack(b'<%dd' %len(features), *features),
+                     struct.pack(b'<%dH' %len(points), *points),
+                     struct.pack(b'<%dq' %len(word_counts), *[long(c) for c in word_counts])])
+
+def _unpack_line(record):
+    ''' Convert a record into a phrase table line [src,tgt,features,alignment,counts]
+    '''
+    fields = _record_fields(record)
+    return [fields[0],fields[1],_unpack_field(record,fields,2),_unpack_field(record,fields,3),_unpack_field(record,fields,4)]
+
+def _record_fields(record):
+    ''' The phrases of a record, followed by the struct formats and offsets of
+        its features, alignment and counts
+    '''
+    mid = record.index(b' ||| ')
+    end = record.index(b' |||', mid+5)
+
+    pos = end+4
+    n_features,n_alignment,n_counts = RECORD_HEADER.unpack_from(record,pos)
+    pos += RECORD_HEADER.size
+    return [record[1:mid], record[mid+5:end],
+            (b'<%dd' %n_features, pos),
+            (b'<%dH' %(2*n_alignment), pos + 8*n_features),
+            (b'<%dq' %n_counts, pos + 8*n_features + 4*n_alignment)]
+
+def _unpack_field(record,fields,index):
+    ''' Decode the features (2), the alignment (3) or the counts (4) of a record
+    '''
+    fmt,pos = fields[index]
+    values = struct.unpack_from(fmt,record,pos)
+    if (index == 3):
+        return [[values[i],values[i+1]] for i in range(0,len(values),2)]
+    return list(values)
+
+# An indexed table: magic, records sorted by pivot phrase, the pivot keys (see _pivot_key),
+#   one entry per pivot phrase and a last one with the ends of the keys and records, footer
+INDEX_MAGIC = b'TMTINDEX\x01\n'
+INDEX_ENTRY = struct.Struct(b'<QQ') # offset of the pivot key, offset of the first record of its group
+INDEX_FOOTER = struct.Struct(b'<QQQ') # end of the records, offset of the entries, number of pivot phrases
+
+class IndexedTable():
+    """ A phrase table of binary records with an index of its pivot phrases, see binarize_table
+        The records of a pivot phrase are looked up by binary search over the sorted keys
+    """
+    def __init__(self,filename):
+        self.name = filename
+        self.fileobj = open(filename,'rb')
+        self.map = mmap.mmap(self.fileobj.fileno(),0,access=mmap.ACCESS_READ)
+        self.end,self.entries,self.groups = INDEX_FOOTER.unpack_from(self.map,len(self.map)-INDEX_FOOTER.size)
+        self.start = len(INDEX_MAGIC)
+        self.size = self.end - self.start
+
+    def __len__(self):
+        return self.groups
+
+    def _entry(self,i):
+        return INDEX_ENTRY.unpack_from(self.map,self.entries+i*INDEX_ENTRY.size)
+
+    def key(self,i):
+        return self.map[self._entry(i)[0]:self._entry(i+1)[0]]
+
+    def _search(self,key):
+        ''' The number of the first pivot phrase whose key is not smaller than key
+        '''
+        low,high = 0,self.groups
+        while (low < high):
+            mid = (low+high)//2
+            if (self.key(mid) < key):
+                low = mid+1
+            else:
+                high = mid
+        return low
+
+    def lookup(self,key):
+        ''' The lines of a pivot phrase as PhraseRecords, None if the table does not have it
+        '''
+        i = self._search(key)
+        if (i == self.groups or self.key(i) != key):
+            return None
+        pos,end = self._entry(i)[1],self._entry(i+1)[1]
+        lines = []
+        while (pos < end):
+            length = RECORD_LENGTH.unpack_from(self.map,pos)[0]
+            pos += RECORD_LENGTH.size
+            lines.append(PhraseRecord(self.map[pos:pos+length]))
+            pos += length
+        return lines
+
+    def cut_keys(self,jobs):
+        ''' The keys of the pivot phrases which cut the table into `jobs` parts of equally many pivot phrases
+        '''
+        return sorted(set([self.key(self.groups*i//jobs) for i in range(1,jobs) if self.groups*i//jobs < self.groups]))
+
+    def seek_pivots(self,keys):
+        ''' The offsets of the first records whose pivot keys are not smaller than the keys
+        '''
+        return [self._entry(self._search(key))[1] for key in keys]
+
+    def close(self):
+        self.map.close()
+        self.fileobj.close()
+
+def _is_indexed(filename):
+    ''' Whether a file is an indexed table
+    '''
+    if not os.path.isfile(filename):
+        return False
+    with open(filename,'rb') as infile:
+        return infile.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+def _open_table(filename):
+    ''' Open an input phrase table, an indexed table as IndexedTable
+    '''
+    if _is_indexed(filename):
+        return IndexedTable(filename)
+    return handle_file(filename,'open',mode='r')
+
+def binarize_table(filename,output,invert=False,tempdir=None):
+    ''' Convert a phrase table into an indexed table, sorted by its first phrase,
+        or by its second phrase with invert (see _inverted_lines)
+    '''
+    if os.path.isdir(filename):
+        filename = os.path.join(filename,'model','phrase-table')
+    model = handle_file(filename,'open',mode='r')
+    lines = model
+    if (invert):
+        lines = _inverted_lines(lines)
+    sys.stderr.write("Binarize {0} > {1} ...".format(filename, output))
+    records = sort_lines((_pack_line(_load_line(line)) for line in lines if line.strip()),tempdir=tempdir,records=True)
+
+    # the keys wait in a temporary file until the records are written
+    keys = NamedTemporaryFile(delete=False,dir=tempdir,prefix='keys')
+    key_offsets,record_offsets = array(b'L'),array(b'L')
+    outfile = open(output,'wb')
+    outfile.write(INDEX_MAGIC)
+    pos,key_pos,last = len(INDEX_MAGIC),0,None
+    for record in records:
+        key = _raw_pivot_key(record)
+        if (key != last):
+            keys.write(key)
+            key_offsets.append(key_pos)
+            record_offsets.append(pos)
+            key_pos += len(key)
+            last = key
+        _write_record(outfile,record)
+        pos += RECORD_LENGTH.size + len(record)
+    handle_file(filename,'close',model,mode='r')
+
+    # the offsets of the keys follow the records
+    end = pos
+    keys.seek(0)
+    shutil.copyfileobj(keys,outfile)
+    keys.close()
+    os.remove(keys.name)
+    entries = end + key_pos
+    key_offsets.append(key_pos)
+    record_offsets.append(end)
+    for key_offset,record_offset in izip(key_offsets,record_offsets):
+        outfile.write(INDEX_ENTRY.pack(end+key_offset,record_offset))
+    outfile.write(INDEX_FOOTER.pack(end,entries,len(key_offsets)-1))
+    outfile.close()
+    sys.stderr.write("Done: {0} pivot phrases\n".format(len(key_offsets)-1))
+
+# --------------------------------------------------------------------------
+# Section 8: Compressed files and asynchronous writing
+#   Inputs are decompressed by a background thread, gzip outputs are
+#   compressed block by block into concatenated gzip members
+#   All outputs are written by a background thread
+# --------------------------------------------------------------------------
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+
+def _open_compressed(filename):
+    """ Open a file for reading, gzip, zstd and lz4 files are recognised by their magic numbers
+    """
+    fileobj = open(filename,'rb')
+    magic = fileobj.read(4)
+    fileobj.seek(0)
+    if (magic[:2] == GZIP_MAGIC):
+        chunks = _gzip_chunks(fileobj)
+    elif (magic == ZSTD_MAGIC):
+        if zstandard is None:
+            raise ImportError("The zstandard module is required to read {0}".format(filename))
+        chunks = _stream_chunks(zstandard.ZstdDecompressor().stream_reader(fileobj))
+    elif (magic == LZ4_MAGIC):
+        if lz4frame is None:
+            raise ImportError("The lz4 module is required to read {0}".format(filename))
+        chunks = _stream_chunks(lz4frame.open(fileobj,'rb'))
+    else:
+        return fileobj
+    return _ThreadedReader(fileobj,chunks)
+
+def _gzip_chunks(fileobj):
+    """ Yield the decompressed blocks of a gzip file, which may consist of several members
+    """
+    decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+    data = fileobj.read(io_block_size)
+    while data:
+        block = decompressor.decompress(data)
+        if block:
+            yield block
+        # the data after the end of a member starts the next one
+        data = decompressor.unused_data
+        if data:
+            decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+        else:
+            data = fileobj.read(io_block_size)
+    block = decompressor.flush()
+    if block:
+        yield block
+
+def _stream_chunks(stream):
+    """ Yield the decompressed blocks of a zstd or lz4 stream
+    """
+    block = stream.read(io_block_size)
+    while block:
+        yield block
+        block = stream.read(io_block_size)
+
+class _ThreadedReader():
+    """ Read the blocks of a decompressor, run by a background thread, like a file of lines
+        At most io_queue_size blocks wait in the queue
+    """
+    def __init__(self,fileobj,chunks):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.queue = Queue(io_queue_size)
+        self.buffer = b''
+        self.pos = 0
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self._decompress,args=(chunks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _decompress(self,chunks):
+        try:
+            for block in chunks:
+                if (self.closed):
+                    return
+                self.queue.put(block)
+            self.queue.put(None)
+        except Exception as error:
+            # raised again by the reading thread
+            self.queue.put(error)
+
+    def _fill(self):
+        ''' Append the next block to the buffer, return False at the end of the file
+        '''
+        if (self.eof):
+            return False
+        block = self.queue.get()
+        if isinstance(block,Exception):
+            raise block
+        if block is None:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def readline(self):
+        end = self.buffer.find(b'\n',self.pos)
+        while (end < 0):
+            start = len(self.buffer) - self.pos
+            if not self._fill():
+                end = len(self.buffer)-1
+                break
+            end = self.buffer.find(b'\n',start)
+        line = self.buffer[self.pos:end+1]
+        self.pos = end+1
+        return line
+
+    def read(self,size=-1):
+        while ((size < 0 or len(self.buffer) - self.pos < size) and self._fill()):
+            pass
+        if (size < 0):
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos+size]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+    def close(self):
+        self.closed = True
+        # unblock the background thread
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self.fileobj.close()
+
+def _gzip_member(block,level):
+    ''' Compress a block into a complete gzip member
+    '''
+    compressor = zlib.compressobj(level,zlib.DEFLATED,16+zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+class _GzipWriter():
+    """ Write a gzip file as a sequence of members of io_block_size bytes each (like pigz),
+        which are compressed by a pool of threads and written in order
+    """
+    def __init__(self,filename,threads=1,level=6):
+        self.name = filename
+        self.fileobj = open(filename,'wb')
+        self.level = level
+        self.threads = threads
+        self.pool = None
+        if (threads > 1):
+            self.pool = ThreadPool(threads)
+        self.pending = deque()
+        self.buffer,self.size = [],0
+
+    def write(self,data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if (self.size >= io_block_size):
+            self._compress()
+
+    def writelines(self,lines):
+        for line in lines:
+            self.write(line)
+
+    def _compress(self):
+        block = b''.join(self.buffer)
+        self.buffer,self.size = [],0
+        if (self.pool is None):
+            self.fileobj.write(_gzip_member(block,self.level))
+            return
+        # zlib releases the GIL while compressing
+        self.pending.append(self.pool.apply_async(_gzip_member,(block,self.level)))
+        while (len(self.pending) > 2*self.threads):
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        if (self.size):
+            self._compress()
+        while (self.pending):
+            self.fileobj.write(self.pending.popleft().get())
+        self.fileobj.flush()
+
+    def close(self):
+        self.flush()
+        if (self.pool is not None):
+            self.pool.close()
+            self.pool.join()
+        self.fileobj.close()
+
+class _AsyncWriter():
+    """ Collect the writes into blocks of io_block_size bytes, which a background thread
+        writes to the file (and compresses, see _GzipWriter)
+        At most io_queue_size blocks wait in the queue, a full queue blocks the writes
+    """
+    def __init__(self,fileobj):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj,'name',None)
+        self.queue = Queue(io_queue_size)
+        self.buffer,self.size = [],0
+        self.written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._write_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write_blocks(self):
+        while True:
+            block = self.queue.get()
+            try:
+                if block is None:
+                    return
+                if self.error is None:
+                    self.fileobj.write(block)
+            except Exception as error:
+                # raised again by the writing thread
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self,data):
+        self.buffer.append(data)
+        self.size += len(data)
+        self.written += len(data)
+        if (self.size >= io_block_size):
+            self._check()
+            self.queue.put(b''.join(self.buffer))
+            self.buffer,self.size = [],0
+
+    def writelines(self,lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        ''' the number of bytes written (a new file)
+        '''
+        return self.written
+
+    def flush(self):
+        ''' Wait until everything written so far is in the file
+        '''
+        if (self.buffer):
+            self.queue.put(b''.join(self.buffer))
+            self.buffer,self.size = [],0
+        self.queue.join()
+        self._check()
+        self.fileobj.flush()
+
+    def close(self,closefile=True):
+        if (self.buffer):
+            self.queue.put(b''.join(self.buffer))
+            self.buffer,self.size = [],0
+        self.queue.put(None)
+        self.thread.join()
+        if (closefile):
+            self.fileobj.close()
+        else:
+            self.fileobj.flush()
+        self._check()
+
 # --------------------------------------------------------------------------
 # Section 0: Main function
 # --------------------------------------------------------------------------
@@ -1016,27 +3280,59 @@ if __name__ == "__main__":
 
     if len(sys.argv) < 2:
         sys.stderr.write("no command specified. use option -h for usage instructions\n")
+    elif sys.argv[1] == "binarize":
+        args = parse_binarize_command_line()
+        sort_buffer_size = args.sort_buffer_size
+        binarize_table(args.input, args.output, invert=args.invert, tempdir=args.tmp)
     else:
         args = parse_command_line()
-        #1 Triangulate phrase pairs
-        triangulator = Triangulate_TMs(weight=args.weight,
-                               model1=args.srcpvt,
-                               model2=args.pvttgt,
+        sort_buffer_size = args.sort_buffer_size
+        sort_compress = args.sort_compress
+        io_threads = args.io_threads or args.jobs
+        #1 Triangulate phrase pairs, one triangulation per pivot language
+        pivots = zip(args.srcpvt, args.pvttgt)
+        triangulators = []
+        for idx,(srcpvt,pvttgt) in enumerate(pivots):
+            output_file = 'phrase-table'
+            if (len(pivots) > 1):
+                output_file = 'phrase-table.pivot{0}'.format(idx)
+            triangulators.append(Triangulate_TMs(weight=args.weight,
+                               model1=srcpvt,
+                               model2=pvttgt,
                                mode=args.mode,
-                               output_file=os.path.normpath('/'.join([args.tmp, 'phrase-table'])),
+                               output_file=os.path.normpath('/'.join([args.tmp, output_file])),
                                action=args.action,
                                computed=args.computation,
                                output_lexical=args.outlex,
                                tempdir=args.tmp,
                                number_of_features=args.number_of_features,
-                               write_phrase_penalty=args.write_phrase_penalty)
-
-        triangulator.triangulate_standard()
-
-        #2: Sort the temporary file
-        tmpfile = sort_file(triangulator.output_file,tempdir=args.tmp)
-        sys.stderr.write("Remove the unsorted phrase table {0}\n".format(triangulator.output_file))
-        os.remove(triangulator.output_file)
+                               write_phrase_penalty=args.write_phrase_penalty,
+                               jobs=max(1, args.jobs // len(pivots)),
+                               fused=args.fused,
+                               max_pivot_fanout=args.max_pivot_fanout,
+                               min_prob=args.min_prob,
+                               min_count=args.min_count,
+                               memory_limit=args.memory_limit,
+                               incremental=args.incremental,
+                               cache=args.cache,
+                               cache_records=args.cache_records,
+                               join=args.join))
+        triangulator = triangulators[0]
+
+        if (len(triangulators) > 1):
+            #2: Triangulate the pivot languages concurrently and merge their sorted outputs
+            tmpfile = triangulate_pivots(triangulators)
+        else:
+            triangulator.triangulate_standard()
+
+            #2: Sort the temporary file
+            #   The sorted phrase pairs stream into the merge, and the temporary file
+            #   is removed once it is read, see _read_run and sort_file_lines
+            if (triangulator.fused):
+                # the combined phrase pairs are already sorted
+                tmpfile = _read_run(triangulator.output_file,None,records=True)
+            else:
+                tmpfile = sort_file_lines(triangulator.output_file,tempdir=args.tmp,records=True)
 
         #3: Combine idential phrase pairs
         merger = Merge_TM(model=tmpfile,
@@ -1046,5 +3342,6 @@ if __name__ == "__main__":
                           output_lexical=triangulator.output_lexical,
                           moses_interface=triangulator.moses_interface,
                           weight=args.weight,
-                          tempdir=args.tmp)
+                          tempdir=args.tmp,
+                          max_targets=args.max_targets)
         merger._combine_TM()